@@ -0,0 +1,20 @@
+# asgi.py
+# ASGI entry point for main.py. uvicorn's event loop owns the sockets, so
+# slow clients and idle keep-alive connections don't tie up a thread; the
+# Flask app itself runs on a bounded pool of ASGI_WORKERS threads, which caps
+# how many requests one process works on at once. Inside a request,
+# independent Datastore / GCS / Auth0 calls still fan out through
+# main.run_concurrently.
+#
+#   uvicorn asgi:app --host 0.0.0.0 --port 8080
+#
+# Route contracts are identical to the WSGI app (flask run / gunicorn main:app).
+import os
+
+from a2wsgi import WSGIMiddleware
+
+from main import app as flask_app
+
+ASGI_WORKERS = int(os.getenv('ASGI_WORKERS', 32))
+
+app = WSGIMiddleware(flask_app, workers=ASGI_WORKERS)
@@ -0,0 +1,136 @@
+# auth_stub.py
+# Local stand-in for the Auth0 endpoints main.py talks to, so benchmarks run
+# fully offline. Serves a JWKS document for a freshly generated RSA key and a
+# password-grant /oauth/token endpoint, and mints id_tokens that verify_jwt
+# accepts when main.py runs with JWKS_URL pointing here and the same
+# DOMAIN / CLIENT_ID.
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+KID = 'bench-key'
+
+
+def _b64_uint(n):
+    raw = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+class AuthStub:
+    """
+    Signs tokens for DOMAIN / CLIENT_ID and serves them over HTTP.
+    Any username is accepted by /oauth/token with the configured password;
+    the token's sub is 'bench|<username>'.
+    """
+
+    def __init__(self, domain, client_id, password='bench', token_ttl=3600):
+        self.domain = domain
+        self.client_id = client_id
+        self.password = password
+        self.token_ttl = token_ttl
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self._pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode('ascii')
+        numbers = key.public_key().public_numbers()
+        self.jwks = {"keys": [{
+            "kty": "RSA",
+            "kid": KID,
+            "use": "sig",
+            "alg": "RS256",
+            "n": _b64_uint(numbers.n),
+            "e": _b64_uint(numbers.e)
+        }]}
+        self._server = None
+
+    def mint(self, sub):
+        """
+        Return a signed RS256 id_token for sub.
+        """
+        now = int(time.time())
+        claims = {
+            "sub": sub,
+            "aud": self.client_id,
+            "iss": f"https://{self.domain}/",
+            "iat": now,
+            "exp": now + self.token_ttl
+        }
+        return jwt.encode(claims, self._pem, algorithm='RS256', headers={"kid": KID})
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Serve /.well-known/jwks.json and /oauth/token in a daemon thread.
+        Returns the base URL.
+        """
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == '/.well-known/jwks.json':
+                    self._send_json(200, stub.jwks)
+                else:
+                    self._send_json(404, {"error": "not_found"})
+
+            def do_POST(self):
+                if self.path != '/oauth/token':
+                    self._send_json(404, {"error": "not_found"})
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    self._send_json(400, {"error": "invalid_request"})
+                    return
+                if 'username' not in body or 'password' not in body:
+                    self._send_json(400, {"error": "invalid_request"})
+                elif body['password'] != stub.password:
+                    self._send_json(403, {"error": "invalid_grant"})
+                else:
+                    self._send_json(200, {"id_token": stub.mint(f"bench|{body['username']}")})
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the local Auth0 stand-in.")
+    parser.add_argument('--domain', default='bench.local')
+    parser.add_argument('--client-id', default='bench-client')
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+
+    stub = AuthStub(args.domain, args.client_id)
+    url = stub.start(port=args.port)
+    print(f"Auth stub listening on {url} (JWKS_URL={url}/.well-known/jwks.json)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,60 @@
+# compare.py
+# Compare two run_bench.py reports route by route, e.g. a baseline commit
+# against the current one. Exits with status 1 if any route's p95 latency
+# regressed by more than --max-regression percent.
+#
+#   python bench/compare.py bench/results/base.json bench/results/head.json
+import argparse
+import json
+import sys
+
+METRICS = ['throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms']
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports.")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help="allowed p95 increase per route, in percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        base = json.load(f)
+    with open(args.candidate) as f:
+        head = json.load(f)
+
+    print(f"baseline  {base.get('commit')}  ({base.get('timestamp')})")
+    print(f"candidate {head.get('commit')}  ({head.get('timestamp')})")
+    print(f"{'route':<18}" + "".join(f"{m:>24}" for m in METRICS))
+
+    regressions = []
+    for route in sorted(set(base['routes']) | set(head['routes'])):
+        old = base['routes'].get(route, {})
+        new = head['routes'].get(route, {})
+        cells = []
+        for metric in METRICS:
+            pct = change(old.get(metric), new.get(metric))
+            delta = f"{pct:+.1f}%" if pct is not None else "n/a"
+            cells.append(f"{old.get(metric)} -> {new.get(metric)} ({delta})")
+        print(f"{route:<18}" + "".join(f"{c:>24}" for c in cells))
+        p95_change = change(old.get('p95_ms'), new.get('p95_ms'))
+        if p95_change is not None and p95_change > args.max_regression:
+            regressions.append(route)
+
+    total = change(base.get('throughput_rps'), head.get('throughput_rps'))
+    if total is not None:
+        print(f"total throughput {base['throughput_rps']} -> {head['throughput_rps']} rps ({total:+.1f}%)")
+    if regressions:
+        print(f"p95 regressed more than {args.max_regression}% on: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
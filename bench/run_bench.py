@@ -0,0 +1,398 @@
+# run_bench.py
+# Offline load test for main.py. Boots the app against the Datastore emulator,
+# a fake GCS server and the local Auth0 stand-in (auth_stub.py), seeds a
+# synthetic dataset, replays a weighted mix of routes and reports throughput
+# and p50/p95/p99 latency per route as JSON.
+#
+# Prerequisites (both emulators running locally):
+#   gcloud beta emulators datastore start --no-store-on-disk --host-port=localhost:8081
+#   docker run -p 4443:4443 fsouza/fake-gcs-server -scheme http
+#   export DATASTORE_EMULATOR_HOST=localhost:8081
+#   export STORAGE_EMULATOR_HOST=http://localhost:4443
+#   export GOOGLE_CLOUD_PROJECT=bench
+#
+# Example:
+#   python bench/run_bench.py --users 2000 --courses 200 --duration 60 \
+#       --concurrency 16 --output bench/results/$(git rev-parse --short HEAD).json
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from google.api_core.exceptions import Conflict
+from google.cloud import datastore, storage
+
+from auth_stub import AuthStub
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERS_KIND = 'users'
+COURSES_KIND = 'courses'
+ENROLLMENTS_KIND = 'enrollments'
+BATCH_SIZE = 500  # max entities per put_multi
+DOMAIN = 'bench.local'
+CLIENT_ID = 'bench-client'
+SUBJECTS = ['ART', 'BIO', 'CHEM', 'CS', 'ECE', 'ENG', 'HIST', 'MATH', 'MUS', 'PHYS']
+# Smallest valid PNG (1x1 transparent pixel), padded to a realistic size
+AVATAR_PNG = (
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00'
+    b'\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00'
+    b'\x00\x00\x00IEND\xaeB`\x82'
+) + b'\x00' * 20000
+
+DEFAULT_MIX = 'list_courses=40,get_course=25,get_user=20,patch_enrollment=10,get_avatar=5'
+
+
+def parse_mix(spec):
+    """
+    Parse 'route=weight,...' into {route: weight}.
+    """
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ROUTES:
+            raise SystemExit(f"Unknown route in --mix: {name.strip()} (choose from {', '.join(ROUTES)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def put_in_batches(client, entities):
+    for i in range(0, len(entities), BATCH_SIZE):
+        client.put_multi(entities[i:i + BATCH_SIZE])
+
+
+def seed(args, ds, gcs):
+    """
+    Create admins, instructors, students and courses with random rosters.
+    Returns the IDs the workload needs.
+    """
+    rng = random.Random(args.seed)
+    n_instructors = max(1, args.users // 20)
+    n_admins = 1
+    n_students = max(1, args.users - n_instructors - n_admins)
+
+    def make_users(role, count):
+        entities = []
+        for i in range(count):
+            entity = datastore.Entity(key=ds.key(USERS_KIND))
+            entity.update({"sub": f"bench|{role}{i}", "role": role})
+            entities.append(entity)
+        put_in_batches(ds, entities)
+        return [(e.key.id, e['sub']) for e in entities]
+
+    started = time.monotonic()
+    admins = make_users('admin', n_admins)
+    instructors = make_users('instructor', n_instructors)
+    students = make_users('student', n_students)
+    student_ids = [sid for sid, _ in students]
+
+    courses = []
+    for i in range(args.courses):
+        size = min(len(student_ids), max(0, int(rng.gauss(args.roster_size, args.roster_size / 3))))
+        entity = datastore.Entity(key=ds.key(COURSES_KIND))
+        entity.update({
+            "subject": rng.choice(SUBJECTS),
+            "number": rng.randint(100, 599),
+            "title": f"Course {i}",
+            "term": rng.choice(['fall-24', 'winter-25', 'spring-25']),
+            "instructor_id": rng.choice(instructors)[0],
+            "students": sorted(rng.sample(student_ids, size))
+        })
+        courses.append(entity)
+    put_in_batches(ds, courses)
+
+    # Mirror the rosters into 'enrollments' when the app runs in entity mode
+    if os.getenv('ENROLLMENT_STORAGE') == 'entity':
+        enrollments = []
+        for course in courses:
+            for sid in course['students']:
+                entity = datastore.Entity(key=ds.key(ENROLLMENTS_KIND, f"{course.key.id}-{sid}"))
+                entity.update({"course_id": course.key.id, "student_id": sid})
+                enrollments.append(entity)
+        put_in_batches(ds, enrollments)
+
+    # Give a share of students an avatar, recorded the way main.py does
+    bucket = gcs.bucket(args.bucket)
+    try:
+        gcs.create_bucket(args.bucket)
+    except Conflict:
+        pass
+    avatar_students = students[:max(1, int(len(students) * args.avatar_share))]
+    updated = []
+    for sid, sub in avatar_students:
+        blob = bucket.blob(f"avatars/{sid}.png")
+        blob.upload_from_file(io.BytesIO(AVATAR_PNG), content_type='image/png')
+        user = ds.get(ds.key(USERS_KIND, sid))
+        user['avatar_generation'] = blob.generation
+        updated.append(user)
+    put_in_batches(ds, updated)
+
+    print(f"Seeded {len(admins) + len(instructors) + len(students)} users, {len(courses)} courses, "
+          f"{len(avatar_students)} avatars in {time.monotonic() - started:.1f}s", file=sys.stderr)
+    return {
+        "admins": admins,
+        "students": students,
+        "avatar_students": avatar_students,
+        "course_ids": [c.key.id for c in courses]
+    }
+
+
+def start_app(args, auth_url):
+    """
+    Launch main.py in a subprocess configured against the local stand-ins.
+    Returns (process, base_url) once GET / answers.
+    """
+    env = dict(os.environ)
+    env.update({
+        "DOMAIN": DOMAIN,
+        "CLIENT_ID": CLIENT_ID,
+        "CLIENT_SECRET": "bench-secret",
+        "AVATAR_BUCKET": args.bucket,
+        "JWKS_URL": f"{auth_url}/.well-known/jwks.json"
+    })
+    if args.server_cmd:
+        cmd = args.server_cmd.format(port=args.port).split()
+    else:
+        cmd = [sys.executable, '-m', 'flask', '--app', 'main', 'run',
+               '--host', '127.0.0.1', '--port', str(args.port), '--no-reload', '--with-threads']
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"App exited during startup with code {proc.returncode}")
+        try:
+            if requests.get(base_url + '/', timeout=1).status_code == 200:
+                return proc, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("App did not become ready within 30s")
+
+
+# Each route takes (session, base_url, data, rng, tokens) and returns a response
+def list_courses(session, base, data, rng, tokens):
+    # Page through up to three pages, like a catalog browser
+    url = base + '/courses?limit=10'
+    resp = None
+    for _ in range(rng.randint(1, 3)):
+        resp = session.get(url)
+        nxt = resp.json().get('next') if resp.status_code == 200 else None
+        if not nxt:
+            break
+        url = nxt
+    return resp
+
+
+def search_courses(session, base, data, rng, tokens):
+    # Filtered, projected catalog search
+    term = rng.choice(['fall-24', 'winter-25', 'spring-25'])
+    return session.get(f"{base}/courses?term={term}&subject={rng.choice(SUBJECTS)}"
+                       f"&fields=id,number,title&limit=20")
+
+
+def get_course(session, base, data, rng, tokens):
+    return session.get(f"{base}/courses/{rng.choice(data['course_ids'])}")
+
+
+def get_user(session, base, data, rng, tokens):
+    sid, sub = rng.choice(data['students'])
+    return session.get(f"{base}/users/{sid}", headers=tokens.auth(sub))
+
+
+def get_schedule(session, base, data, rng, tokens):
+    # A student's profile, then all of their courses in one batch read
+    sid, sub = rng.choice(data['students'])
+    resp = session.get(f"{base}/users/{sid}", headers=tokens.auth(sub))
+    course_ids = [url.rsplit('/', 1)[1] for url in resp.json().get('courses', [])] \
+        if resp.status_code == 200 else []
+    if not course_ids:
+        return resp
+    return session.get(f"{base}/courses?ids={','.join(course_ids)}")
+
+
+def patch_enrollment(session, base, data, rng, tokens):
+    course_id = rng.choice(data['course_ids'])
+    sid, _ = rng.choice(data['students'])
+    body = {"add": [sid], "remove": []} if rng.random() < 0.5 else {"add": [], "remove": [sid]}
+    admin_sub = data['admins'][0][1]
+    return session.patch(f"{base}/courses/{course_id}/students", json=body,
+                         headers=tokens.auth(admin_sub))
+
+
+def get_avatar(session, base, data, rng, tokens):
+    sid, sub = rng.choice(data['avatar_students'])
+    return session.get(f"{base}/users/{sid}/avatar", headers=tokens.auth(sub))
+
+
+ROUTES = {
+    "list_courses": list_courses,
+    "search_courses": search_courses,
+    "get_course": get_course,
+    "get_user": get_user,
+    "get_schedule": get_schedule,
+    "patch_enrollment": patch_enrollment,
+    "get_avatar": get_avatar
+}
+
+
+class TokenPool:
+    """
+    Mints one id_token per sub on first use, like a client reusing its login.
+    """
+
+    def __init__(self, stub):
+        self._stub = stub
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def auth(self, sub):
+        with self._lock:
+            if sub not in self._tokens:
+                self._tokens[sub] = self._stub.mint(sub)
+            return {"Authorization": f"Bearer {self._tokens[sub]}"}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_workload(args, base_url, data, tokens, mix):
+    """
+    Replay the weighted route mix from args.concurrency threads for
+    args.duration seconds. Returns {route: [(latency_seconds, ok), ...]}.
+    """
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    samples = {name: [] for name in names}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def worker(worker_id):
+        rng = random.Random(args.seed + worker_id)
+        session = requests.Session()
+        local = {name: [] for name in names}
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            shed = False
+            try:
+                resp = ROUTES[name](session, base_url, data, rng, tokens)
+                ok = resp is not None and resp.status_code < 400
+                # Turned away by admission control rather than failed
+                shed = resp is not None and resp.status_code in (429, 503)
+            except requests.RequestException:
+                ok = False
+            local[name].append((time.perf_counter() - started, ok, shed))
+        with lock:
+            for name in names:
+                samples[name].extend(local[name])
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(worker, range(args.concurrency)))
+    return samples
+
+
+def summarize(samples, duration):
+    routes = {}
+    total = 0
+    for name, values in samples.items():
+        latencies = sorted(latency for latency, _, _ in values)
+        total += len(values)
+        routes[name] = {
+            "requests": len(values),
+            "errors": sum(1 for _, ok, _ in values if not ok),
+            "shed": sum(1 for _, _, shed in values if shed),
+            "throughput_rps": round(len(values) / duration, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None
+        }
+    return routes, round(total / duration, 2)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the Tarpaulin API.")
+    parser.add_argument('--users', type=int, default=500, help="total users to seed")
+    parser.add_argument('--courses', type=int, default=100, help="courses to seed")
+    parser.add_argument('--roster-size', type=int, default=30, help="mean students per course")
+    parser.add_argument('--avatar-share', type=float, default=0.2, help="share of students with an avatar")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="weighted routes, e.g. " + DEFAULT_MIX)
+    parser.add_argument('--duration', type=float, default=30, help="seconds of load per run")
+    parser.add_argument('--warmup', type=float, default=3, help="seconds of unrecorded load first")
+    parser.add_argument('--concurrency', type=int, default=8, help="client threads")
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--bucket', default='bench-avatars')
+    parser.add_argument('--server-cmd', help="command to serve main:app; {port} is substituted, "
+                                             "e.g. 'gunicorn -w 4 --threads 8 -b 127.0.0.1:{port} main:app' or "
+                                             "'uvicorn asgi:app --host 127.0.0.1 --port {port}'")
+    parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--output', help="write the JSON report here as well as stdout")
+    args = parser.parse_args()
+
+    for var in ('DATASTORE_EMULATOR_HOST', 'STORAGE_EMULATOR_HOST'):
+        if not os.getenv(var):
+            raise SystemExit(f"{var} is not set; the benchmark only runs against local emulators")
+    mix = parse_mix(args.mix)
+
+    ds = datastore.Client()
+    gcs = storage.Client()
+    stub = AuthStub(DOMAIN, CLIENT_ID, token_ttl=int(args.duration + args.warmup) + 3600)
+    auth_url = stub.start()
+    data = seed(args, ds, gcs)
+    tokens = TokenPool(stub)
+
+    proc, base_url = start_app(args, auth_url)
+    try:
+        if args.warmup > 0:
+            warmup_args = argparse.Namespace(**{**vars(args), "duration": args.warmup})
+            run_workload(warmup_args, base_url, data, tokens, mix)
+        samples = run_workload(args, base_url, data, tokens, mix)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        stub.stop()
+
+    routes, total_rps = summarize(samples, args.duration)
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "config": {
+            "users": args.users,
+            "courses": args.courses,
+            "roster_size": args.roster_size,
+            "mix": mix,
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "server_cmd": args.server_cmd or "flask run --with-threads"
+        },
+        "throughput_rps": total_rps,
+        "routes": routes
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
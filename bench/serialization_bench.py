@@ -0,0 +1,122 @@
+# serialization_bench.py
+# Microbenchmark for response serialization: per-item cost of turning course
+# and user entities into JSON, the way the routes used to (a hand-built dict
+# with url_for per row, encoded by Flask's json module) against main.py's
+# Serializer with each available JSON backend. Needs no emulators; entities
+# are built in memory and everything runs inside a test request context.
+#
+#   python bench/serialization_bench.py --items 1000 --repeat 20
+import argparse
+import json
+import os
+import sys
+import time
+
+from flask import url_for
+from flask.json.provider import DefaultJSONProvider
+from google.cloud import datastore
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+SUBJECTS = ['ART', 'BIO', 'CHEM', 'CS', 'ECE', 'ENG', 'HIST', 'MATH', 'MUS', 'PHYS']
+
+
+def build_courses(count):
+    courses = []
+    for i in range(count):
+        course = datastore.Entity(key=datastore.Key(main.COURSES_KIND, 5000000000 + i, project='bench'))
+        course.update({
+            "subject": SUBJECTS[i % len(SUBJECTS)],
+            "number": 100 + i % 500,
+            "title": f"Synthetic course {i}",
+            "term": "fall-25",
+            "instructor_id": 4000000000 + i % 50,
+            "students": list(range(i % 40))
+        })
+        courses.append(course)
+    return courses
+
+
+def build_users(count):
+    users = []
+    for i in range(count):
+        user = datastore.Entity(key=datastore.Key(main.USERS_KIND, 6000000000 + i, project='bench'))
+        user.update({"sub": f"auth0|synthetic-{i}", "role": "student" if i % 10 else "instructor"})
+        users.append(user)
+    return users
+
+
+def legacy_courses(courses):
+    # The shape get_all_courses built before the Serializer
+    return [{
+        "id": c.key.id,
+        "instructor_id": c.get('instructor_id'),
+        "number": c.get('number'),
+        "self": url_for('get_course', course_id=c.key.id, _external=True),
+        "subject": c.get('subject'),
+        "term": c.get('term'),
+        "title": c.get('title')
+    } for c in courses]
+
+
+def legacy_users(users):
+    return [{"id": u.key.id, "role": u.get('role'), "sub": u.get('sub')} for u in users]
+
+
+def time_per_item(func, items, repeat):
+    """
+    Best-of-repeat wall time for func(), in microseconds per item.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best / items * 1e6
+
+
+def run_case(name, rows, build, provider, repeat):
+    main.app.json = provider
+    with main.app.test_request_context('/'):
+        body = build(rows)
+        build_us = time_per_item(lambda: build(rows), len(rows), repeat)
+        encode_us = time_per_item(lambda: main.app.json.dumps(body), len(rows), repeat)
+    return {"case": name, "build_us": round(build_us, 3), "encode_us": round(encode_us, 3),
+            "total_us": round(build_us + encode_us, 3)}
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Per-item cost of course/user response serialization.")
+    parser.add_argument('--items', type=int, default=1000, help="entities per list")
+    parser.add_argument('--repeat', type=int, default=20, help="runs per case; the best is reported")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    courses = build_courses(args.items)
+    users = build_users(args.items)
+    providers = [('std', DefaultJSONProvider(main.app))]
+    if main.orjson is not None:
+        providers.append(('orjson', main.OrjsonProvider(main.app)))
+
+    def serialize_courses(rows):
+        return main.COURSE_SERIALIZER.many((main.entity_id(c), c) for c in rows)
+
+    def serialize_users(rows):
+        return main.USER_SERIALIZER.many((main.entity_id(u), u) for u in rows)
+
+    results = [run_case('courses/legacy+std', courses, legacy_courses, providers[0][1], args.repeat),
+               run_case('users/legacy+std', users, legacy_users, providers[0][1], args.repeat)]
+    for backend, provider in providers:
+        results.append(run_case(f'courses/serializer+{backend}', courses, serialize_courses, provider, args.repeat))
+        results.append(run_case(f'users/serializer+{backend}', users, serialize_users, provider, args.repeat))
+
+    report = {"items": args.items, "repeat": args.repeat, "results": results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,47 @@
+# backfill_enrollment_index.py
+# Rewrites every course so its 'students' roster is an indexed list of unique
+# integer user IDs. GET /users/<id> finds a student's courses with an equality
+# filter on that property, so rosters written as strings, or with 'students'
+# excluded from indexes, would otherwise be missed.
+from google.cloud import datastore
+from dotenv import load_dotenv
+
+load_dotenv()
+
+client = datastore.Client()
+COURSES_KIND = 'courses'
+BATCH_SIZE = 500  # max entities per put_multi
+
+query = client.query(kind=COURSES_KIND)
+batch = []
+scanned = 0
+updated = 0
+
+
+def flush(batch):
+    if batch:
+        client.put_multi(batch)
+        print(f"Rewrote {len(batch)} courses")
+
+
+for course in query.fetch():
+    scanned += 1
+    students = course.get('students') or []
+    normalized = sorted({int(sid) for sid in students})
+    if students == normalized and 'students' not in course.exclude_from_indexes:
+        continue
+
+    fixed = datastore.Entity(
+        key=course.key,
+        exclude_from_indexes=tuple(p for p in course.exclude_from_indexes if p != 'students')
+    )
+    fixed.update(course)
+    fixed['students'] = normalized
+    batch.append(fixed)
+    updated += 1
+    if len(batch) >= BATCH_SIZE:
+        flush(batch)
+        batch = []
+
+flush(batch)
+print(f"✓ Enrollment index backfill complete: {updated} of {scanned} courses rewritten.")
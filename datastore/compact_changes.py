@@ -0,0 +1,144 @@
+# compact_changes.py
+# Retention and compaction for the 'changes' log behind GET /changes.
+#
+# Retention deletes entries older than --retention-days and records the
+# newest deleted ID in change_log/horizon. GET /changes answers a since
+# cursor older than that with 410, so a consumer that fell too far behind
+# knows to resync.
+#
+# Compaction shrinks the entries older than --compact-after-hours (well
+# outside the API's settle window, so nothing is still landing there). For
+# each course it keeps:
+#   - only the course.delete entry, if the course was deleted;
+#   - otherwise its last course.create/update entry, which carries a full
+#     snapshot, and one roster.update entry holding the net change of all
+#     its roster entries (the latest add/remove per student wins).
+# Kept entries keep the ID of the newest entry they replace. A consumer
+# whose cursor sits anywhere in the window still sees every effect, and
+# replaying one it had already applied is a no-op.
+#
+# Safe to re-run; schedule it (e.g. daily) with the same settings:
+#   python compact_changes.py --retention-days 30 --compact-after-hours 24
+import argparse
+import os
+import time
+from google.cloud import datastore
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHANGES_KIND = 'changes'
+CHANGE_LOG_KIND = 'change_log'
+BATCH_SIZE = 500  # max entities per put_multi / delete_multi
+
+
+def change_id_at(seconds_ago):
+    """
+    Lowest change ID written seconds_ago seconds back; IDs start with the
+    write time in nanoseconds.
+    """
+    return f"{int((time.time() - seconds_ago) * 1e9):020d}"
+
+
+def changes_before(client, cutoff, keys_only=False):
+    query = client.query(kind=CHANGES_KIND)
+    query.key_filter(client.key(CHANGES_KIND, cutoff), '<')
+    query.order = ['__key__']
+    if keys_only:
+        query.keys_only()
+    return query.fetch()
+
+
+def write(client, puts, deletes, dry_run):
+    if dry_run:
+        return
+    # Merged entries go in before the ones they replace are removed, so an
+    # interrupted run only leaves duplicates, which are harmless to replay
+    for i in range(0, len(puts), BATCH_SIZE):
+        client.put_multi(puts[i:i + BATCH_SIZE])
+    for i in range(0, len(deletes), BATCH_SIZE):
+        client.delete_multi(deletes[i:i + BATCH_SIZE])
+
+
+def expire(client, cutoff, dry_run):
+    """
+    Delete every entry before cutoff and advance the retention horizon.
+    """
+    keys = [entity.key for entity in changes_before(client, cutoff, keys_only=True)]
+    if not keys:
+        return 0
+    write(client, [], keys, dry_run)
+    if not dry_run:
+        horizon_key = client.key(CHANGE_LOG_KIND, 'horizon')
+        with client.transaction():
+            horizon = client.get(horizon_key) or datastore.Entity(key=horizon_key)
+            horizon['expired_through'] = max(horizon.get('expired_through', ''), keys[-1].name)
+            client.put(horizon)
+    return len(keys)
+
+
+def compact(client, cutoff, dry_run):
+    """
+    Collapse each course's entries before cutoff as described above.
+    Return (entries scanned, entries removed).
+    """
+    # course_id -> {"course": [entities], "roster": [entities], "net": {student_id: op}}
+    courses = {}
+    scanned = 0
+    for change in changes_before(client, cutoff):
+        scanned += 1
+        state = courses.setdefault(change['course_id'], {"course": [], "roster": [], "net": {}})
+        if change['op'] == 'roster.update':
+            state['roster'].append(change)
+            for sid in change.get('add', []):
+                state['net'][sid] = 'add'
+            for sid in change.get('remove', []):
+                state['net'][sid] = 'remove'
+        else:
+            state['course'].append(change)
+
+    puts, deletes = [], []
+    for state in courses.values():
+        last_course_op = state['course'][-1] if state['course'] else None
+        if last_course_op is not None and last_course_op['op'] == 'course.delete':
+            deletes.extend(c.key for c in state['course'][:-1] + state['roster'])
+            continue
+        deletes.extend(c.key for c in state['course'][:-1])
+        if len(state['roster']) > 1:
+            merged = state['roster'][-1]
+            merged['add'] = sorted(sid for sid, op in state['net'].items() if op == 'add')
+            merged['remove'] = sorted(sid for sid, op in state['net'].items() if op == 'remove')
+            puts.append(merged)
+            deletes.extend(c.key for c in state['roster'][:-1])
+
+    write(client, puts, deletes, dry_run)
+    return scanned, len(deletes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expire and compact the GET /changes log.")
+    parser.add_argument('--retention-days', type=float,
+                        default=float(os.getenv('CHANGES_RETENTION_DAYS', 30)),
+                        help="delete entries older than this; 0 keeps everything")
+    parser.add_argument('--compact-after-hours', type=float,
+                        default=float(os.getenv('CHANGES_COMPACT_AFTER_HOURS', 24)),
+                        help="collapse entries older than this; 0 disables compaction")
+    parser.add_argument('--dry-run', action='store_true', help="report what would change without writing")
+    args = parser.parse_args()
+
+    client = datastore.Client()
+
+    if args.retention_days > 0:
+        expired = expire(client, change_id_at(args.retention_days * 86400), args.dry_run)
+        print(f"Expired {expired} entries older than {args.retention_days:g} days")
+
+    if args.compact_after_hours > 0:
+        scanned, removed = compact(client, change_id_at(args.compact_after_hours * 3600), args.dry_run)
+        print(f"Compacted {scanned} entries older than {args.compact_after_hours:g} hours, "
+              f"removing {removed}")
+
+    print("✓ Change log maintenance complete" + (" (dry run)." if args.dry_run else "."))
+
+
+if __name__ == '__main__':
+    main()
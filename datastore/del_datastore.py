@@ -1,25 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
 from google.cloud import datastore
 
-# Make sure your GOOGLE_CLOUD_PROJECT env var is set (or that your Application Default Credentials are pointing at the right project).
-client = datastore.Client()
-
 # List all your kinds here. Add any other kinds you’ve created.
-kinds_to_clear = ["users", "courses"]  
-
-for kind in kinds_to_clear:
-    # Query for all keys in this kind
-    query = client.query(kind=kind)
-    query.keys_only()  # we only need the keys
-    keys = [entity.key for entity in query.fetch()]
-    if not keys:
-        print(f"No entities to delete in kind: {kind}")
-        continue
-
-    # Delete in batches of 500 (max allowed by delete_multi)
-    BATCH_SIZE = 500
-    for i in range(0, len(keys), BATCH_SIZE):
-        batch = keys[i : i + BATCH_SIZE]
-        client.delete_multi(batch)
-        print(f"Deleted {len(batch)} entities from kind '{kind}'")
-
-print("🚮 Datastore wipe complete.")
+kinds_to_clear = ["users", "courses", "enrollments", "changes", "change_log"]
+
+# Delete in batches of 500 (max allowed by delete_multi), several at a time
+BATCH_SIZE = 500
+WORKERS = 16
+
+
+def wipe(client, kinds, workers=WORKERS):
+    """
+    Delete every entity of the given kinds. Keys stream in from a keys-only
+    query and each batch is handed to a thread pool as soon as it fills.
+    """
+    for kind in kinds:
+        started = time.monotonic()
+        query = client.query(kind=kind)
+        query.keys_only()  # we only need the keys
+
+        deleted = 0
+        futures = []
+        batch = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for entity in query.fetch():
+                batch.append(entity.key)
+                if len(batch) == BATCH_SIZE:
+                    futures.append(pool.submit(client.delete_multi, batch))
+                    deleted += len(batch)
+                    batch = []
+            if batch:
+                futures.append(pool.submit(client.delete_multi, batch))
+                deleted += len(batch)
+            for future in futures:
+                future.result()
+
+        if not deleted:
+            print(f"No entities to delete in kind: {kind}")
+            continue
+        elapsed = time.monotonic() - started
+        print(f"Deleted {deleted} entities from kind '{kind}' in {elapsed:.1f}s "
+              f"({deleted / elapsed:.0f}/s)")
+
+
+if __name__ == '__main__':
+    # Make sure your GOOGLE_CLOUD_PROJECT env var is set (or that your Application Default Credentials are pointing at the right project).
+    client = datastore.Client()
+    wipe(client, kinds_to_clear)
+    print("🚮 Datastore wipe complete.")
@@ -0,0 +1,171 @@
+# generate_dataset.py
+# Builds a synthetic users/courses dataset shaped like production so load
+# tests see realistic roster sizes. Users are written first (their IDs are
+# needed for instructor_id and rosters), then courses. Both kinds are written
+# with put_multi batches fanned out over a thread pool.
+#
+# Course popularity follows a Zipf-like curve: a few courses are very large,
+# most are small. Each student enrolls in roughly
+# --mean-courses-per-student courses.
+#
+# Works against the Datastore emulator: export DATASTORE_EMULATOR_HOST first.
+#
+#   python generate_dataset.py --users 100000 --courses 10000 --wipe
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+
+from google.cloud import datastore
+from dotenv import load_dotenv
+
+from del_datastore import wipe
+
+load_dotenv()
+
+USERS_KIND = 'users'
+COURSES_KIND = 'courses'
+ENROLLMENTS_KIND = 'enrollments'
+CHANGES_KIND = 'changes'
+CHANGE_LOG_KIND = 'change_log'
+SUBJECTS = ['CS', 'MTH', 'PH', 'CH', 'BI', 'ECE', 'ME', 'WR', 'HST', 'ART']
+TERMS = ['fall-24', 'winter-25', 'spring-25', 'summer-25', 'fall-25']
+
+
+def write_batches(client, entities, batch_size, workers, label):
+    """
+    put_multi the entities in batch_size chunks across a thread pool, printing
+    progress as batches land. put_multi completes partial keys in place.
+    """
+    batches = [entities[i:i + batch_size] for i in range(0, len(entities), batch_size)]
+    started = time.monotonic()
+    written = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in pool.map(lambda b: client.put_multi(b) or b, batches):
+            written += len(batch)
+            elapsed = time.monotonic() - started
+            print(f"  {label}: {written}/{len(entities)} ({written / max(elapsed, 1e-9):.0f}/s)", end='\r')
+    elapsed = time.monotonic() - started
+    print(f"✓ Wrote {written} {label} in {elapsed:.1f}s ({written / max(elapsed, 1e-9):.0f}/s)")
+
+
+def build_users(client, args):
+    instructors = max(1, int(args.users * args.instructor_share))
+    students = max(0, args.users - instructors - args.admins)
+    roles = ['admin'] * args.admins + ['instructor'] * instructors + ['student'] * students
+    users = []
+    for i, role in enumerate(roles):
+        entity = datastore.Entity(key=client.key(USERS_KIND))
+        entity.update({"sub": f"synthetic|{role}-{i}", "role": role})
+        users.append(entity)
+    return users
+
+
+def build_rosters(student_ids, num_courses, args, rng):
+    """
+    Draw each student's course count around the requested mean, then pick
+    courses weighted by a Zipf-like popularity (rank ** -skew). Courses that
+    hit --max-roster stop accepting students.
+    """
+    weights = [1.0 / (rank + 1) ** args.popularity_skew for rank in range(num_courses)]
+    rng.shuffle(weights)  # don't make course creation order imply popularity
+    cum_weights = list(accumulate(weights))  # lets choices() bisect instead of rescanning
+    rosters = [set() for _ in range(num_courses)]
+    course_ids = range(num_courses)
+    for sid in student_ids:
+        wanted = min(num_courses, max(0, round(rng.gauss(args.mean_courses_per_student, 1.0))))
+        tries = 0
+        chosen = set()
+        while len(chosen) < wanted and tries < wanted * 4:
+            tries += 1
+            course = rng.choices(course_ids, cum_weights=cum_weights)[0]
+            if course in chosen or len(rosters[course]) >= args.max_roster:
+                continue
+            chosen.add(course)
+            rosters[course].add(sid)
+    return rosters
+
+
+def build_courses(client, instructor_ids, rosters, rng, enrollment_storage):
+    courses = []
+    for i, roster in enumerate(rosters):
+        subject = rng.choice(SUBJECTS)
+        entity = datastore.Entity(key=client.key(COURSES_KIND))
+        entity.update({
+            "subject": subject,
+            "number": rng.randint(100, 599),
+            "title": f"{subject} synthetic course {i}",
+            "term": rng.choice(TERMS),
+            "instructor_id": rng.choice(instructor_ids)
+        })
+        if enrollment_storage == 'list':
+            entity['students'] = sorted(roster)
+        courses.append(entity)
+    return courses
+
+
+def build_enrollments(client, courses, rosters):
+    """
+    One 'enrollments' entity per membership, keyed like main.enrollment_key.
+    """
+    enrollments = []
+    for course, roster in zip(courses, rosters):
+        for sid in sorted(roster):
+            entity = datastore.Entity(key=client.key(ENROLLMENTS_KIND, f"{course.key.id}-{sid}"))
+            entity.update({"course_id": course.key.id, "student_id": sid})
+            enrollments.append(entity)
+    return enrollments
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Tarpaulin dataset.")
+    parser.add_argument('--users', type=int, default=1000, help="total users, all roles")
+    parser.add_argument('--courses', type=int, default=100)
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--instructor-share', type=float, default=0.05,
+                        help="fraction of users who are instructors")
+    parser.add_argument('--mean-courses-per-student', type=float, default=4.0)
+    parser.add_argument('--popularity-skew', type=float, default=1.0,
+                        help="Zipf exponent for course popularity; 0 is uniform")
+    parser.add_argument('--max-roster', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=500, help="entities per put_multi (max 500)")
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--enrollment-storage', choices=['list', 'entity'], default='list',
+                        help="match the app's ENROLLMENT_STORAGE setting")
+    parser.add_argument('--wipe', action='store_true',
+                        help="delete existing users, courses, enrollments and the change log first")
+    parser.add_argument('--seed', type=int, default=None, help="random seed for a reproducible dataset")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    client = datastore.Client()
+
+    if args.wipe:
+        print("Wiping existing data...")
+        wipe(client, [USERS_KIND, COURSES_KIND, ENROLLMENTS_KIND, CHANGES_KIND, CHANGE_LOG_KIND],
+             workers=args.workers)
+
+    print(f"Generating {args.users} users...")
+    users = build_users(client, args)
+    write_batches(client, users, args.batch_size, args.workers, 'users')
+
+    instructor_ids = [u.key.id for u in users if u['role'] == 'instructor']
+    student_ids = [u.key.id for u in users if u['role'] == 'student']
+
+    print(f"Building rosters for {args.courses} courses...")
+    rosters = build_rosters(student_ids, args.courses, args, rng)
+    courses = build_courses(client, instructor_ids, rosters, rng, args.enrollment_storage)
+    write_batches(client, courses, args.batch_size, args.workers, 'courses')
+    if args.enrollment_storage == 'entity':
+        enrollments = build_enrollments(client, courses, rosters)
+        write_batches(client, enrollments, args.batch_size, args.workers, 'enrollments')
+
+    memberships = sum(len(r) for r in rosters)
+    largest = max((len(r) for r in rosters), default=0)
+    print(f"✓ Dataset complete: {len(users)} users, {len(courses)} courses, "
+          f"{memberships} enrollments (largest roster {largest}).")
+
+
+if __name__ == '__main__':
+    main()
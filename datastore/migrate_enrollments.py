@@ -0,0 +1,85 @@
+# migrate_enrollments.py
+# Copies every course's 'students' list into one 'enrollments' entity per
+# membership (key name "<course_id>-<student_id>", properties course_id and
+# student_id), the layout main.py uses with ENROLLMENT_STORAGE=entity.
+#
+# The copy reconciles: a course's enrollment entities end up matching its
+# list exactly, so students removed since an earlier run are deleted too.
+# Courses without a 'students' list (already dropped) are left alone.
+#
+# Cutover: run it while still in list mode (as often as you like), run it
+# once more right before deploying ENROLLMENT_STORAGE=entity, then, once the
+# new deployment is serving, run it with --drop-lists. --drop-lists only
+# removes the old lists; it never copies, because after the deploy the lists
+# are stale and copying them would undo roster edits made in entity mode.
+import argparse
+from google.cloud import datastore
+from dotenv import load_dotenv
+
+load_dotenv()
+
+client = datastore.Client()
+COURSES_KIND = 'courses'
+ENROLLMENTS_KIND = 'enrollments'
+BATCH_SIZE = 500  # max entities per put_multi / delete_multi
+
+parser = argparse.ArgumentParser(description="Move course rosters into 'enrollments' entities.")
+parser.add_argument('--drop-lists', action='store_true',
+                    help="only remove the 'students' property from courses; run after the deploy")
+args = parser.parse_args()
+
+puts = []
+deletes = []
+courses_scanned = 0
+memberships = 0
+removed = 0
+dropped = 0
+
+
+def flush(puts, deletes):
+    if puts:
+        client.put_multi(puts)
+        print(f"Wrote {len(puts)} entities")
+    if deletes:
+        client.delete_multi(deletes)
+        print(f"Deleted {len(deletes)} enrollments")
+
+
+def enrolled_ids(course_id):
+    query = client.query(kind=ENROLLMENTS_KIND)
+    query.add_filter('course_id', '=', course_id)
+    query.keys_only()
+    return {int(entity.key.name.rsplit('-', 1)[1]) for entity in query.fetch()}
+
+
+for course in client.query(kind=COURSES_KIND).fetch():
+    courses_scanned += 1
+    if 'students' not in course:
+        continue
+
+    if args.drop_lists:
+        del course['students']
+        puts.append(course)
+        dropped += 1
+    else:
+        students = {int(sid) for sid in course['students'] or []}
+        for sid in sorted(students):
+            enrollment = datastore.Entity(key=client.key(ENROLLMENTS_KIND, f"{course.key.id}-{sid}"))
+            enrollment.update({"course_id": course.key.id, "student_id": sid})
+            puts.append(enrollment)
+            memberships += 1
+        stale = sorted(enrolled_ids(course.key.id) - students)
+        deletes.extend(client.key(ENROLLMENTS_KIND, f"{course.key.id}-{sid}") for sid in stale)
+        removed += len(stale)
+
+    if len(puts) >= BATCH_SIZE or len(deletes) >= BATCH_SIZE:
+        while puts or deletes:
+            flush(puts[:BATCH_SIZE], deletes[:BATCH_SIZE])
+            puts, deletes = puts[BATCH_SIZE:], deletes[BATCH_SIZE:]
+
+flush(puts, deletes)
+if args.drop_lists:
+    print(f"✓ Dropped roster lists from {dropped} of {courses_scanned} courses.")
+else:
+    print(f"✓ Enrollment migration complete: {memberships} memberships from {courses_scanned} courses, "
+          f"{removed} stale removed.")
@@ -0,0 +1,46 @@
+# reconcile_avatars.py
+# Rebuilds the avatar_generation property on 'users' entities from a listing of
+# the avatar bucket. GET /users/<id> decides whether to return avatar_url from
+# that property alone, so run this after deploying it on existing data, or
+# whenever avatars were added or removed outside the API.
+import os
+from google.cloud import datastore, storage
+from dotenv import load_dotenv
+
+load_dotenv()
+
+datastore_client = datastore.Client()
+storage_client = storage.Client()
+AVATAR_BUCKET = os.getenv('AVATAR_BUCKET')
+USERS_KIND = 'users'
+BATCH_SIZE = 500  # max entities per put_multi
+
+# Map user ID -> generation for every avatars/<id>.png object in the bucket
+generations = {}
+for blob in storage_client.list_blobs(AVATAR_BUCKET, prefix='avatars/'):
+    name = blob.name[len('avatars/'):]
+    if name.endswith('.png') and name[:-len('.png')].isdigit():
+        generations[int(name[:-len('.png')])] = blob.generation
+print(f"Found {len(generations)} avatars in gs://{AVATAR_BUCKET}/avatars/")
+
+batch = []
+scanned = 0
+updated = 0
+for user in datastore_client.query(kind=USERS_KIND).fetch():
+    scanned += 1
+    generation = generations.get(user.key.id)
+    if 'avatar_generation' in user and user['avatar_generation'] == generation:
+        continue
+    user['avatar_generation'] = generation
+    batch.append(user)
+    updated += 1
+    if len(batch) >= BATCH_SIZE:
+        datastore_client.put_multi(batch)
+        print(f"Updated {len(batch)} users")
+        batch = []
+
+if batch:
+    datastore_client.put_multi(batch)
+    print(f"Updated {len(batch)} users")
+
+print(f"✓ Avatar reconciliation complete: {updated} of {scanned} users updated.")
@@ -25,6 +25,7 @@ users_to_create = [
 ]
 
 print("Seeding users...")
+entities = []
 for user in users_to_create:
     key = datastore_client.key(USERS_KIND)
     entity = datastore.Entity(key=key)
@@ -32,5 +33,9 @@ for user in users_to_create:
         "sub": user["sub"],
         "role": user["role"]
     })
-    datastore_client.put(entity)
-    print(f"✓ Created {user['role']} with sub={user['sub']} → Datastore ID: {entity.key.id}")
+    entities.append(entity)
+
+# One round trip for the whole list; put_multi fills in each entity's key ID
+datastore_client.put_multi(entities)
+for entity in entities:
+    print(f"✓ Created {entity['role']} with sub={entity['sub']} → Datastore ID: {entity.key.id}")
@@ -1,20 +1,52 @@
+import time
+# Marks the start of module import for the startup-time report
+_IMPORT_STARTED = time.perf_counter()
+
 import os
+import bisect
+import contextlib
+import csv
+import hashlib
+import io
+import math
+import re
+import sys
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, send_file, url_for
+from flask import (Flask, Response, copy_current_request_context, g, has_request_context,
+                   request, jsonify, stream_with_context, url_for)
+from flask.json.provider import DefaultJSONProvider
 from google.cloud import datastore, storage
+from google.api_core.exceptions import Aborted, BadRequest, FailedPrecondition, NotFound
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from io import BytesIO
-from six.moves.urllib.request import urlopen
-from jose import jwt
-from authlib.integrations.flask_client import OAuth
+from jose import jwt, jwk
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 app.secret_key = 'SECRET_KEY'
 
-# Initialize Datastore and Storage clients
-datastore_client = datastore.Client()
-storage_client = storage.Client()
+# Datastore and Storage clients are created lazily on first use
+# (see get_datastore_client / get_storage_client) to keep cold starts fast
+_clients_lock = threading.Lock()
+_datastore_client = None
+_storage_client = None
+_auth0_session = None
 
 # Load environment variables
 load_dotenv()
@@ -26,21 +58,200 @@ DOMAIN = os.getenv('DOMAIN')
 
 ALGORITHMS = ["RS256"]
 
-# OAuth registration for Auth0
-oauth = OAuth(app)
-auth0 = oauth.register(
-    'auth0',
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    api_base_url=f"https://{DOMAIN}",
-    access_token_url=f"https://{DOMAIN}/oauth/token",
-    authorize_url=f"https://{DOMAIN}/authorize",
-    client_kwargs={'scope': 'openid profile email'},
-)
+# Outbound Auth0 traffic shares one keep-alive connection pool with bounded
+# retries (backoff on 5xx, connect errors and timeouts). AUTH0_BASE_URL can
+# point at a local stand-in for testing.
+AUTH0_BASE_URL = os.getenv('AUTH0_BASE_URL', f"https://{DOMAIN}")
+AUTH0_POOL_SIZE = int(os.getenv('AUTH0_POOL_SIZE', 20))
+AUTH0_TIMEOUT = float(os.getenv('AUTH0_TIMEOUT', 5))
+AUTH0_RETRIES = int(os.getenv('AUTH0_RETRIES', 2))
+AUTH0_RETRY_BACKOFF = float(os.getenv('AUTH0_RETRY_BACKOFF', 0.2))
+
+# JWKS key store settings
+JWKS_URL = os.getenv('JWKS_URL', f"{AUTH0_BASE_URL}/.well-known/jwks.json")
+JWKS_TTL = int(os.getenv('JWKS_TTL', 3600))
+JWKS_MIN_REFETCH_INTERVAL = int(os.getenv('JWKS_MIN_REFETCH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.getenv('JWKS_FETCH_TIMEOUT', 5))
+
+# Verified-token cache size (entries expire at the token's exp claim)
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+
+# Identity cache: sub -> user entity for USER_CACHE_TTL seconds, and
+# sub -> datastore key for USER_KEY_CACHE_TTL seconds (point gets, no query)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))
+USER_KEY_CACHE_TTL = int(os.getenv('USER_KEY_CACHE_TTL', 86400))
+
+# Course read-through cache. Writes on this instance invalidate it at once;
+# COURSE_CACHE_TTL bounds how long other instances can serve a stale copy.
+# Set COURSE_CACHE_REDIS_URL to share one cache across instances instead.
+COURSE_CACHE_SIZE = int(os.getenv('COURSE_CACHE_SIZE', 5000))
+COURSE_CACHE_TTL = int(os.getenv('COURSE_CACHE_TTL', 30))
+COURSE_CACHE_REDIS_URL = os.getenv('COURSE_CACHE_REDIS_URL')
+
+# Requests slower than SLOW_REQUEST_PROFILE_MS get a sampled stack profile
+# written to PROFILE_DIR in collapsed-stack (flamegraph.pl) format; 0 disables.
+SLOW_REQUEST_PROFILE_MS = float(os.getenv('SLOW_REQUEST_PROFILE_MS', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/tarpaulin-profiles')
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.005))
 
 # Datastore kind names
 USERS_KIND = 'users'
 COURSES_KIND = 'courses'
+ENROLLMENTS_KIND = 'enrollments'
+CHANGES_KIND = 'changes'
+CHANGE_LOG_KIND = 'change_log'
+
+# Max keys per get_multi / put_multi call, and retries for contended transactions
+GET_MULTI_BATCH_SIZE = 1000
+WRITE_BATCH_SIZE = 500
+TRANSACTION_RETRIES = int(os.getenv('TRANSACTION_RETRIES', 3))
+
+# GET /courses paging. Pages are read with Datastore cursors either way;
+# first-page 'next' links stay offset links (what the Postman suite and
+# existing clients expect) until COURSES_NEXT_LINK=cursor switches them over.
+COURSES_PAGE_SIZE = 3
+COURSES_MAX_PAGE_SIZE = int(os.getenv('COURSES_MAX_PAGE_SIZE', 50))
+COURSES_NEXT_LINK = os.getenv('COURSES_NEXT_LINK', 'offset')
+
+# GET /courses filters and fields= projection. The number filter is a digit
+# prefix of a COURSE_NUMBER_DIGITS-digit course number. Every filter
+# combination needs a composite index declared in index.yaml.
+COURSE_FILTERS = ('term', 'subject', 'instructor_id', 'number')
+COURSE_PROPERTIES = ('instructor_id', 'number', 'subject', 'term', 'title')
+COURSE_FIELDS = ('id', 'self') + COURSE_PROPERTIES
+COURSE_NUMBER_DIGITS = int(os.getenv('COURSE_NUMBER_DIGITS', 3))
+
+# Enrollment storage. 'list' keeps each roster in the course's 'students'
+# property; 'entity' stores one 'enrollments' entity per membership, so roster
+# edits only write the students that changed. Existing rosters move over with
+# datastore/migrate_enrollments.py. Rosters are returned in pages of
+# ENROLLMENT_PAGE_SIZE IDs in 'entity' mode (or when a client passes limit).
+ENROLLMENT_STORAGE = os.getenv('ENROLLMENT_STORAGE', 'list')
+ENROLLMENT_PAGE_SIZE = int(os.getenv('ENROLLMENT_PAGE_SIZE', 1000))
+
+# Largest GET /users page (and the default when no limit is given)
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', 1000))
+
+# Most IDs accepted by one GET /courses?ids= or GET /users?ids= batch read
+MAX_BATCH_IDS = int(os.getenv('MAX_BATCH_IDS', 100))
+
+# Concurrent identical fetches (course loads, sub lookups, avatar metadata,
+# JWKS) share one backend call; waiters fetch on their own after this long
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 5))
+
+# Threads shared by all requests for running independent backend calls of
+# one request concurrently (see run_concurrently)
+BACKEND_FANOUT_WORKERS = int(os.getenv('BACKEND_FANOUT_WORKERS', 32))
+
+# Bulk catalog / roster import and export (/courses/import, /courses/export,
+# /rosters/import, /rosters/export) as CSV or NDJSON. Uploads are parsed
+# incrementally and validated IMPORT_BATCH_SIZE rows at a time; exports are
+# streamed EXPORT_CHUNK_ROWS rows per chunk. At most IMPORT_MAX_ERRORS
+# rejected rows are itemized in an import report.
+# NDJSON comes first: it is the default, so a wildcard Accept (*/*) picks it
+BULK_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+CATALOG_COLUMNS = ('id',) + COURSE_PROPERTIES
+ROSTER_COLUMNS = ('course_id', 'student_id')
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+IMPORT_MAX_ERRORS = int(os.getenv('IMPORT_MAX_ERRORS', 100))
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', 500))
+
+# Change feed (GET /changes). Every course and roster write appends a
+# 'changes' entry in its own transaction; names start with the write time in
+# nanoseconds, so key order is time order. Entries younger than
+# CHANGES_SETTLE_SECONDS are held back so a transaction that began earlier
+# but commits later can't land behind a reader's cursor. Retention and
+# compaction are run by datastore/compact_changes.py.
+CHANGES_PAGE_SIZE = int(os.getenv('CHANGES_PAGE_SIZE', 1000))
+CHANGES_SETTLE_SECONDS = float(os.getenv('CHANGES_SETTLE_SECONDS', 5))
+# A since cursor is a change ID, or a bare 20-digit nanosecond timestamp
+CHANGE_ID_PATTERN = re.compile(r'\d{20}(-[0-9a-f]{8})?')
+
+# Avatars are streamed from GCS in chunks of this many bytes
+AVATAR_CHUNK_SIZE = int(os.getenv('AVATAR_CHUNK_SIZE', 256 * 1024))
+
+# Admission control. ROUTE_CONCURRENCY caps concurrent requests per endpoint
+# ("endpoint=limit,..."; empty disables). Up to ADMISSION_MAX_QUEUE more wait
+# at most ADMISSION_QUEUE_TIMEOUT seconds for a slot; the rest are shed with a
+# 503 and Retry-After: ADMISSION_RETRY_AFTER. With RATE_LIMIT_PER_SUB set
+# (requests/second; 0 disables), each authenticated sub also gets a token
+# bucket holding up to RATE_LIMIT_BURST requests, and over-limit requests get
+# a 429.
+ROUTE_CONCURRENCY = os.getenv('ROUTE_CONCURRENCY', 'get_user=16,update_course_enrollment=8,'
+                              'create_or_update_avatar=4,import_courses=2,import_rosters=2')
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 16))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 0.5))
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 1))
+RATE_LIMIT_PER_SUB = float(os.getenv('RATE_LIMIT_PER_SUB', 0))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', 20))
+RATE_LIMIT_MAX_SUBS = int(os.getenv('RATE_LIMIT_MAX_SUBS', 10000))
+
+# JSON encoding: 'auto' uses orjson when it is installed (pip install orjson),
+# 'std' keeps Flask's json module. Long lists (GET /users) are streamed,
+# encoding JSON_STREAM_CHUNK items at a time.
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+JSON_STREAM_CHUNK = int(os.getenv('JSON_STREAM_CHUNK', 200))
+URL_ID_PLACEHOLDER = '__id__'
+
+
+# Import and first-response timings, reported at /metrics and /_ah/warmup
+startup_report = {
+    "import_seconds": None,
+    "first_response_seconds": None,
+    "warmed_up": False
+}
+
+
+def get_datastore_client():
+    """
+    Return the shared Datastore client, creating it on first use.
+    The client is thread-safe, so one instance serves every request.
+    """
+    global _datastore_client
+    if _datastore_client is None:
+        with _clients_lock:
+            if _datastore_client is None:
+                _datastore_client = datastore.Client()
+    return _datastore_client
+
+
+def get_storage_client():
+    """
+    Return the shared Storage client, creating it on first use.
+    """
+    global _storage_client
+    if _storage_client is None:
+        with _clients_lock:
+            if _storage_client is None:
+                _storage_client = storage.Client()
+    return _storage_client
+
+
+def get_auth0_session():
+    """
+    Return the shared requests.Session used for all Auth0 calls, creating it
+    on first use. Its pooled adapter keeps connections warm between logins
+    and retries 5xx responses, connect errors and timeouts with backoff.
+    """
+    global _auth0_session
+    if _auth0_session is None:
+        with _clients_lock:
+            if _auth0_session is None:
+                retry = Retry(
+                    total=AUTH0_RETRIES,
+                    backoff_factor=AUTH0_RETRY_BACKOFF,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=frozenset({'GET', 'POST'}),
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AUTH0_POOL_SIZE,
+                                      max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _auth0_session = session
+    return _auth0_session
 
 
 # AuthError exception for JWT issues
@@ -57,6 +268,772 @@ def handle_auth_error(ex):
     return response
 
 
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask's JSON provider with orjson doing the encoding and decoding.
+    Honors the same sort_keys and compact / debug settings, so responses
+    carry the same JSON as with the default provider.
+    """
+    def _options(self):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.compact is False or (self.compact is None and self._app.debug):
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._options()) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+if JSON_BACKEND == 'auto' and orjson is not None:
+    app.json = OrjsonProvider(app)
+
+
+class Histogram:
+    """
+    Thread-safe Prometheus-style histogram, one series per label tuple.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """
+        Return the histogram in Prometheus text exposition format.
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (buckets, total, count) in sorted(self._series.items()):
+                label_str = ",".join(f'{n}="{v}"' for n, v in zip(self.label_names, labels))
+                for bound, bucket_count in zip(self.BUCKETS, buckets):
+                    lines.append(f'{self.name}_bucket{{{label_str},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label_str},le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{label_str}}} {total}")
+                lines.append(f"{self.name}_count{{{label_str}}} {count}")
+        return lines
+
+
+request_duration = Histogram(
+    'tarpaulin_request_duration_seconds', 'Time spent handling a request.',
+    ('route', 'method', 'status'))
+backend_duration = Histogram(
+    'tarpaulin_backend_duration_seconds', 'Time spent in one Datastore, GCS or Auth0 call.',
+    ('route', 'backend'))
+admission_wait = Histogram(
+    'tarpaulin_admission_wait_seconds', 'Time an admitted request queued for a concurrency slot.',
+    ('route',))
+
+
+@contextlib.contextmanager
+def backend_timer(backend):
+    """
+    Time a Datastore ('datastore'), GCS ('gcs') or Auth0 ('auth0') call and
+    attribute it to the current request's route. Calls made outside a
+    request (e.g. background refreshes) are recorded under route 'none'.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        route = 'none'
+        if has_request_context():
+            route = request.endpoint or 'none'
+            timings = g.setdefault('backend_timings', {})
+            total, count = timings.get(backend, (0.0, 0))
+            timings[backend] = (total + elapsed, count + 1)
+        backend_duration.observe((route, backend), elapsed)
+
+
+# Independent backend calls within one request fan out on this pool
+_backend_pool = ThreadPoolExecutor(max_workers=BACKEND_FANOUT_WORKERS,
+                                   thread_name_prefix='backend-fanout')
+_fanout_local = threading.local()
+
+
+def run_concurrently(*calls):
+    """
+    Run independent zero-argument callables on the backend pool and return
+    their results in order. The first exception, in call order, is re-raised
+    once every call has finished. Each call sees a copy of the current
+    request context, and its backend time is folded back into this
+    request's Server-Timing. Calls already running on the pool (and single
+    calls) run inline, so nested fan-outs can't exhaust the pool.
+    """
+    if len(calls) < 2 or getattr(_fanout_local, 'active', False):
+        return [call() for call in calls]
+
+    def wrap(call):
+        def run():
+            _fanout_local.active = True
+            try:
+                g.backend_timings = {}
+                return call(), g.backend_timings
+            finally:
+                _fanout_local.active = False
+        return copy_current_request_context(run) if has_request_context() else run
+
+    futures = [_backend_pool.submit(wrap(call)) for call in calls]
+    results = []
+    error = None
+    for future in futures:
+        try:
+            result = future.result()
+        except Exception as e:
+            error = error or e
+            continue
+        value, timings = result
+        results.append(value)
+        if has_request_context():
+            merged = g.setdefault('backend_timings', {})
+            for backend, (total, count) in timings.items():
+                prev_total, prev_count = merged.get(backend, (0.0, 0))
+                merged[backend] = (prev_total + total, prev_count + count)
+    if error is not None:
+        raise error
+    return results
+
+
+class StackSampler:
+    """
+    Samples one thread's Python stack every interval seconds in a helper
+    thread and counts collapsed stacks ("outer;...;inner") for flamegraphs.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    fetch and callers arriving while it is in flight wait and share its
+    result, or re-raise its exception. A waiter that gives up after timeout
+    seconds runs the fetch itself rather than failing its request.
+    Results are shared between threads, so callers must not mutate them.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, name, timeout):
+        self.name = name
+        self.timeout = timeout
+        self.calls = 0
+        self.shared = 0
+        self.timeouts = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._inflight
+
+    def do(self, key, fetch):
+        """
+        Return fetch() for key, sharing one call among concurrent callers.
+        """
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = self._Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                call.result = fetch()
+                return call.result
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                call.done.set()
+
+        if not call.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            return fetch()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "shared": self.shared,
+                "timeouts": self.timeouts,
+                "in_flight": len(self._inflight),
+                "timeout": self.timeout
+            }
+
+
+course_flight = SingleFlight('courses', SINGLE_FLIGHT_TIMEOUT)
+user_flight = SingleFlight('identities', SINGLE_FLIGHT_TIMEOUT)
+blob_flight = SingleFlight('blobs', SINGLE_FLIGHT_TIMEOUT)
+jwks_flight = SingleFlight('jwks', SINGLE_FLIGHT_TIMEOUT)
+flights = (course_flight, user_flight, blob_flight, jwks_flight)
+
+
+class ConcurrencyLimiter:
+    """
+    Caps how many requests to one route run at once. Up to max_queue more
+    wait, first come first served, for at most queue_timeout seconds; a
+    request that finds the queue full, or is still waiting at the timeout,
+    is shed so it fails fast instead of adding to everyone's latency.
+    """
+
+    def __init__(self, name, limit, max_queue, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Take a slot, queueing if none is free. Return the seconds spent
+        queued, or None if the request was shed.
+        """
+        with self._cond:
+            # Newcomers don't jump ahead of requests already queued
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return 0.0
+            if self.waiting >= self.max_queue:
+                self.shed_queue_full += 1
+                return None
+            started = time.monotonic()
+            self.waiting += 1
+            try:
+                admitted = self._cond.wait_for(lambda: self.active < self.limit, self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.shed_timeout += 1
+                return None
+            self.active += 1
+            self.admitted += 1
+            return time.monotonic() - started
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "waiting": self.waiting,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "shed_queue_full": self.shed_queue_full,
+                "shed_timeout": self.shed_timeout
+            }
+
+
+class TokenBuckets:
+    """
+    Thread-safe token bucket per key: each key earns rate tokens a second,
+    up to burst, and each request spends one. Only the maxsize most recently
+    seen keys are kept; a forgotten key starts again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, maxsize):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.allowed = 0
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """
+        Spend one of key's tokens. Return 0 if one was available, otherwise
+        the seconds until the next one is earned.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self.allowed += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "keys": len(self._buckets),
+                "allowed": self.allowed,
+                "limited": self.limited
+            }
+
+
+def parse_route_limits(spec):
+    """
+    Parse 'endpoint=limit,...' into {endpoint: limit}.
+    """
+    limits = {}
+    for part in spec.split(','):
+        if part.strip():
+            name, _, limit = part.partition('=')
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+route_limiters = {
+    route: ConcurrencyLimiter(route, limit, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT)
+    for route, limit in parse_route_limits(ROUTE_CONCURRENCY).items()
+}
+sub_buckets = (TokenBuckets(RATE_LIMIT_PER_SUB, RATE_LIMIT_BURST, RATE_LIMIT_MAX_SUBS)
+               if RATE_LIMIT_PER_SUB > 0 else None)
+
+
+class JWKSKeyStore:
+    """
+    In-process cache of the Auth0 signing keys, parsed once and indexed by kid.
+    Keys are loaded on first use and refreshed in a background thread once they
+    are older than ttl; the old keys keep serving if a refresh fails.
+    A token carrying an unknown kid triggers a synchronous refetch. Either
+    kind of fetch starts at most once per min_refetch_interval seconds, so
+    an Auth0 outage costs one attempt per interval rather than one per
+    request. Concurrent fetches are coalesced through jwks_flight.
+    """
+
+    def __init__(self, url, ttl, min_refetch_interval):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        """
+        Download the JWKS document and parse its RSA keys.
+        Returns {kid: jose Key}.
+        """
+        with backend_timer('auth0'):
+            r = get_auth0_session().get(self.url, timeout=JWKS_FETCH_TIMEOUT)
+            r.raise_for_status()
+            jwks = r.json()
+        keys = {}
+        for key in jwks.get("keys", []):
+            if key.get("kty") != "RSA" or "kid" not in key:
+                continue
+            rsa_key = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key.get("use"),
+                "n": key["n"],
+                "e": key["e"]
+            }
+            keys[key["kid"]] = jwk.construct(rsa_key, ALGORITHMS[0])
+        return keys
+
+    def refresh(self):
+        """
+        Refetch the key set and replace the cached keys.
+        Returns the new {kid: key} mapping; raises if the fetch fails.
+        """
+        return jwks_flight.do(self.url, self._load)
+
+    def _load(self):
+        # Only called through jwks_flight, so one fetch runs at a time.
+        with self._lock:
+            self._last_attempt = time.monotonic()
+        keys = self._fetch()
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return keys
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print("JWKS background refresh failed:", e)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _recently_attempted(self):
+        # Caller holds self._lock
+        return (self._last_attempt is not None
+                and time.monotonic() - self._last_attempt < self.min_refetch_interval)
+
+    def get_key(self, kid):
+        """
+        Return the parsed signing key for kid, or None if it isn't published
+        (or the keys can't be fetched right now).
+        """
+        start_refresh = False
+        with self._lock:
+            key = self._keys.get(kid)
+            if (self._fetched_at is not None and not self._refreshing
+                    and time.monotonic() - self._fetched_at > self.ttl
+                    and not self._recently_attempted()):
+                self._refreshing = True
+                start_refresh = True
+        if start_refresh:
+            threading.Thread(target=self._background_refresh, daemon=True).start()
+        if key is not None:
+            return key
+
+        # Unknown kid (or nothing loaded yet): refetch once, rate limited.
+        # Callers arriving while a fetch is in flight join it instead.
+        with self._lock:
+            # A fetch may have landed since the first look (its flight is
+            # then already over), so check the keys again before giving up
+            key = self._keys.get(kid)
+            recently_attempted = self._recently_attempted()
+        if key is not None:
+            return key
+        if recently_attempted and not jwks_flight.in_flight(self.url):
+            return None
+        try:
+            return self.refresh().get(kid)
+        except Exception as e:
+            # Unreachable or broken JWKS endpoint: the token can't be
+            # verified, which is a 401 rather than a server error
+            print("JWKS refetch failed:", e)
+            return None
+
+
+jwks_store = JWKSKeyStore(JWKS_URL, JWKS_TTL, JWKS_MIN_REFETCH_INTERVAL)
+
+
+class LRUCache:
+    """
+    Thread-safe bounded LRU mapping where each entry carries its own expiry
+    (a time.time() timestamp). Counts hits and misses for reporting.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if absent or expired.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] <= time.time():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None
+            }
+
+
+# Verified JWT payloads keyed by a SHA-256 digest of the raw token
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+
+# Identity caches used by require_auth_and_get_user
+user_cache = LRUCache(USER_CACHE_SIZE)
+user_key_cache = LRUCache(USER_CACHE_SIZE)
+
+
+class LocalCacheBackend:
+    """
+    Course cache backend that keeps entries in this process's memory.
+    """
+    name = 'local'
+    shared = False
+
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def get_many(self, keys):
+        return [self._cache.get(key) for key in keys]
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, time.time() + ttl)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def get_counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def stats(self):
+        stats = self._cache.stats()
+        return {"size": stats["size"], "maxsize": stats["maxsize"]}
+
+
+class RedisCacheBackend:
+    """
+    Course cache backend shared by every instance through Redis. Values are
+    stored as JSON; Redis errors are logged and treated as cache misses.
+    """
+    name = 'redis'
+    shared = True
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.errors = 0
+
+    def _call(self, method, *args, default=None):
+        try:
+            return getattr(self._client, method)(*args)
+        except redis.RedisError as e:
+            self.errors += 1
+            print("Course cache (redis) error:", e)
+            return default
+
+    def get(self, key):
+        value = self._call('get', key)
+        return json.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        values = self._call('mget', keys) or [None] * len(keys)
+        return [json.loads(value) if value is not None else None for value in values]
+
+    def set(self, key, value, ttl):
+        self._call('set', key, json.dumps(value), ttl)
+
+    def delete(self, key):
+        self._call('delete', key)
+
+    def get_counter(self, key):
+        return int(self._call('get', key) or 0)
+
+    def incr(self, key):
+        self._call('incr', key)
+
+    def stats(self):
+        return {"errors": self.errors}
+
+
+class CourseCache:
+    """
+    Read-through cache for course entities and GET /courses pages.
+    Values are plain JSON-serializable dicts so any backend can hold them.
+    Page keys embed a version counter; any course write bumps it, which
+    retires every cached page at once.
+    """
+    PAGE_VERSION_KEY = 'courses:page-version'
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_course(self, course_id, loader):
+        """
+        Return the cached dict for course_id, calling loader() on a miss.
+        loader returns the course dict or None; None results aren't cached.
+        """
+        key = f"course:{int(course_id)}"
+        value = self.backend.get(key)
+        self._count(value is not None)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.backend.set(key, value, self.ttl)
+        return value
+
+    def get_courses(self, course_ids, loader):
+        """
+        Return {course_id: cached dict} for many courses with one backend
+        read, calling loader(missing_ids) once for the misses. loader returns
+        {course_id: dict}; courses it leaves out are absent from the result.
+        """
+        course_ids = list(dict.fromkeys(int(cid) for cid in course_ids))
+        values = self.backend.get_many([f"course:{cid}" for cid in course_ids])
+        found = {cid: value for cid, value in zip(course_ids, values) if value is not None}
+        missing = [cid for cid in course_ids if cid not in found]
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            loaded = loader(missing)
+            for cid, value in loaded.items():
+                self.backend.set(f"course:{cid}", value, self.ttl)
+            found.update(loaded)
+        return found
+
+    def get_page(self, page_args, loader):
+        """
+        Return the cached GET /courses page for page_args, calling loader()
+        on a miss.
+        """
+        version = self.backend.get_counter(self.PAGE_VERSION_KEY)
+        key = f"courses:page:{version}:" + ":".join(str(a) for a in page_args)
+        value = self.backend.get(key)
+        self._count(value is not None)
+        if value is None:
+            value = loader()
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, course_id=None, pages=True):
+        """
+        Drop the cached course (if given) and, unless pages is False,
+        every cached course page.
+        """
+        if course_id is not None:
+            self.backend.delete(f"course:{int(course_id)}")
+        if pages:
+            self.backend.incr(self.PAGE_VERSION_KEY)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "backend": self.backend.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "ttl": self.ttl,
+                # Another instance's write is only seen here once entries expire,
+                # unless the backend is shared
+                "max_staleness_seconds": 0 if self.backend.shared else self.ttl
+            }
+        stats.update(self.backend.stats())
+        return stats
+
+
+if COURSE_CACHE_REDIS_URL and redis is not None:
+    course_cache = CourseCache(RedisCacheBackend(COURSE_CACHE_REDIS_URL), COURSE_CACHE_TTL)
+else:
+    if COURSE_CACHE_REDIS_URL:
+        print("COURSE_CACHE_REDIS_URL is set but redis is not installed; using the local cache")
+    course_cache = CourseCache(LocalCacheBackend(COURSE_CACHE_SIZE), COURSE_CACHE_TTL)
+
+
 def verify_jwt(request):
     """
     Verify JWT in Authorization header using Auth0 JWKS.
@@ -71,8 +1048,10 @@ def verify_jwt(request):
         raise AuthError({"Error": "Unauthorized"}, 401)
 
     token = parts[1]
-    jsonurl = urlopen(f"https://{DOMAIN}/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    token_digest = hashlib.sha256(token.encode()).hexdigest()
+    payload = token_cache.get(token_digest)
+    if payload is not None:
+        return payload
 
     try:
         unverified_header = jwt.get_unverified_header(token)
@@ -82,17 +1061,8 @@ def verify_jwt(request):
     if unverified_header.get("alg") != "RS256":
         raise AuthError({"Error": "Unauthorized"}, 401)
 
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
-    if not rsa_key:
+    rsa_key = jwks_store.get_key(unverified_header.get("kid"))
+    if rsa_key is None:
         raise AuthError({"Error": "Unauthorized"}, 401)
 
     try:
@@ -111,17 +1081,29 @@ def verify_jwt(request):
         raise AuthError({"Error": "Unauthorized"}, 401)
 
     print("JWT payload:", payload)
+    if isinstance(payload.get('exp'), (int, float)):
+        token_cache.set(token_digest, payload, payload['exp'])
     return payload
 
 
+def entity_id(entity):
+    """
+    Return a stored entity's numeric ID. Key.id deep-copies the key path on
+    every access, which adds up over long lists; the last element of
+    flat_path is the same value without the copy.
+    """
+    return entity.key.flat_path[-1]
+
+
 def get_user_by_sub(sub):
     """
     Query Datastore 'users' for an entity with the given Auth0 subject.
     Return the entity or None.
     """
-    query = datastore_client.query(kind=USERS_KIND)
+    query = get_datastore_client().query(kind=USERS_KIND)
     query.add_filter('sub', '=', sub)
-    results = list(query.fetch(limit=1))
+    with backend_timer('datastore'):
+        results = list(query.fetch(limit=1))
     return results[0] if results else None
 
 
@@ -130,11 +1112,135 @@ def get_user_by_id(user_id):
     Retrieve Datastore 'users' entity by numeric ID.
     Return the entity or None.
     """
-    key = datastore_client.key(USERS_KIND, int(user_id))
-    user = datastore_client.get(key)
+    key = get_datastore_client().key(USERS_KIND, int(user_id))
+    with backend_timer('datastore'):
+        user = get_datastore_client().get(key)
     return user
 
 
+def get_entities_by_ids(kind, ids):
+    """
+    Retrieve Datastore entities of kind for many numeric IDs using chunked
+    get_multi calls. Return {id: entity}; missing IDs are left out.
+    """
+    keys = [get_datastore_client().key(kind, int(eid)) for eid in dict.fromkeys(ids)]
+    entities = {}
+    for i in range(0, len(keys), GET_MULTI_BATCH_SIZE):
+        with backend_timer('datastore'):
+            batch = get_datastore_client().get_multi(keys[i:i + GET_MULTI_BATCH_SIZE])
+        for entity in batch:
+            entities[entity_id(entity)] = entity
+    return entities
+
+
+def get_users_by_ids(user_ids):
+    """
+    Retrieve Datastore 'users' entities for many numeric IDs.
+    Return {id: entity}; missing IDs are left out.
+    """
+    return get_entities_by_ids(USERS_KIND, user_ids)
+
+
+def fetch_user_page(cursor, limit):
+    """
+    Read one GET /users page as a projection on role and sub, so only the
+    (role, sub) index is scanned and no entities are fetched. Falls back to
+    full entities if that index hasn't been deployed. Return (users,
+    next_cursor) where next_cursor is None on the last page.
+    Raises ValueError or BadRequest for a malformed cursor.
+    """
+    def run(projection, start_cursor, limit):
+        query = get_datastore_client().query(kind=USERS_KIND)
+        if projection:
+            query.projection = ['role', 'sub']
+        with backend_timer('datastore'):
+            iterator = query.fetch(start_cursor=start_cursor, limit=limit)
+            return iterator, list(next(iterator.pages))
+
+    projection = True
+    try:
+        iterator, users = run(projection, cursor, limit)
+    except FailedPrecondition:
+        projection = False
+        iterator, users = run(projection, cursor, limit)
+
+    # Same one-entity probe as fetch_course_page before advertising a next page
+    next_cursor = iterator.next_page_token
+    if len(users) < limit or not next_cursor:
+        return users, None
+    _, more = run(projection, next_cursor, 1)
+    if not more:
+        return users, None
+    return users, next_cursor.decode('ascii')
+
+
+def parse_batch_ids(raw):
+    """
+    Parse a comma-separated ?ids= value into a list of ints, keeping order
+    and duplicates. Raises ValueError if any ID is malformed or there are
+    more than MAX_BATCH_IDS.
+    """
+    ids = [int(part) for part in raw.split(',') if part.strip()]
+    if not ids or len(ids) > MAX_BATCH_IDS:
+        raise ValueError(raw)
+    return ids
+
+
+def run_in_transaction(func, retries=TRANSACTION_RETRIES):
+    """
+    Call func() inside a Datastore transaction and return its result.
+    Retries with a short backoff if the commit aborts on contention.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with backend_timer('datastore'), get_datastore_client().transaction():
+                return func()
+        except Aborted:
+            if attempt == retries:
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+
+def get_cached_user_by_sub(sub):
+    """
+    Return the user entity for sub through the identity cache, or None.
+    On a miss, a cached sub -> key mapping turns the lookup into a point get;
+    otherwise falls back to the get_user_by_sub query.
+    """
+    user = user_cache.get(sub)
+    if user is not None:
+        return user
+
+    def load():
+        user = None
+        key = user_key_cache.get(sub)
+        if key is not None:
+            with backend_timer('datastore'):
+                user = get_datastore_client().get(key)
+            if user is not None and user.get('sub') != sub:
+                user = None
+        if user is None:
+            user = get_user_by_sub(sub)
+
+        if user is not None:
+            now = time.time()
+            user_cache.set(sub, user, now + USER_CACHE_TTL)
+            user_key_cache.set(sub, user.key, now + USER_KEY_CACHE_TTL)
+        return user
+
+    # A burst of first requests from one user shares a single lookup
+    return user_flight.do(sub, load)
+
+
+def invalidate_user_cache(sub):
+    """
+    Drop the cached identity for sub. Call after changing a user's role or
+    other properties so the next request re-reads the entity.
+    The sub -> key mapping is kept; a user's key never changes.
+    """
+    user_cache.delete(sub)
+
+
 def require_auth_and_get_user(request):
     """
     Verify JWT and fetch corresponding user entity from Datastore.
@@ -143,7 +1249,7 @@ def require_auth_and_get_user(request):
     """
     payload = verify_jwt(request)
     sub = payload.get('sub')
-    user = get_user_by_sub(sub)
+    user = get_cached_user_by_sub(sub)
     if not user:
         raise AuthError({"Error": "Unauthorized"}, 403)
     return payload, user
@@ -182,23 +1288,804 @@ def get_course_by_id(course_id):
     Retrieve Datastore 'courses' entity by numeric ID.
     Return the entity or None.
     """
-    key = datastore_client.key(COURSES_KIND, int(course_id))
-    course = datastore_client.get(key)
+    key = get_datastore_client().key(COURSES_KIND, int(course_id))
+    with backend_timer('datastore'):
+        course = get_datastore_client().get(key)
     return course
 
 
-def check_blob_exists(bucket_name, blob_name):
+def course_to_cache(course):
     """
-    Check if a blob exists in the given GCS bucket.
+    Convert a 'courses' entity into the plain dict stored by course_cache.
     """
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    return blob.exists()
+    value = dict(course)
+    value['id'] = entity_id(course)
+    return value
+
+
+def course_from_cache(value):
+    """
+    Rebuild a read-only 'courses' entity from a course_cache dict.
+    """
+    course = datastore.Entity(key=get_datastore_client().key(COURSES_KIND, value['id']))
+    course.update({k: list(v) if isinstance(v, list) else v
+                   for k, v in value.items() if k != 'id'})
+    return course
+
+
+def get_cached_course_value(course_id):
+    """
+    Return the course_cache dict for a course (loading it on a miss), or
+    None. Cheap enough to answer conditional requests without rebuilding
+    the entity.
+    """
+    def load():
+        course = get_course_by_id(course_id)
+        return course_to_cache(course) if course else None
+
+    # Concurrent misses for a cold course share one Datastore read
+    return course_cache.get_course(course_id, lambda: course_flight.do(str(course_id), load))
+
+
+def course_etag(value):
+    """
+    Strong ETag for GET /courses/<id>, from the course's 'version' counter.
+    Courses written before versioning count as version 0.
+    """
+    return f"c{value['id']}-v{value.get('version', 0)}"
+
+
+def roster_etag(value):
+    """
+    Strong ETag for GET /courses/<id>/students, from 'roster_version'.
+    """
+    return f"r{value['id']}-v{value.get('roster_version', 0)}"
+
+
+def bump_version(course, prop):
+    """
+    Increment a course's version counter ('version' or 'roster_version').
+    Call inside the transaction that writes the change it describes.
+    """
+    course[prop] = course.get(prop, 0) + 1
+    course.exclude_from_indexes.add(prop)
+
+
+def not_modified(etag, weak=False):
+    """
+    Return a 304 response if the request's If-None-Match matches etag,
+    otherwise None.
+    """
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=weak)
+    return response
+
+
+def course_query_plan(filters, fields):
+    """
+    Work out how to run a filtered / projected GET /courses query.
+    filters maps term, subject, instructor_id and number (a digit prefix)
+    to request values; fields is the requested response fields or None.
+    Return (equality, number_range, order, projection) where projection is
+    None for full entities and [] for a keys-only query.
+    Raises ValueError for a malformed filter value.
+    """
+    equality = {}
+    for name in ('term', 'subject'):
+        if filters.get(name) is not None:
+            equality[name] = filters[name]
+    if filters.get('instructor_id') is not None:
+        equality['instructor_id'] = int(filters['instructor_id'])
+
+    number_range = None
+    prefix = filters.get('number')
+    if prefix is not None:
+        if not prefix.isdigit():
+            raise ValueError(prefix)
+        if len(prefix) >= COURSE_NUMBER_DIGITS:
+            equality['number'] = int(prefix)
+        else:
+            # "4" matches 400-499 and "49" matches 490-499
+            scale = 10 ** (COURSE_NUMBER_DIGITS - len(prefix))
+            number_range = (int(prefix) * scale, (int(prefix) + 1) * scale)
+
+    # An inequality filter has to lead the sort order, and sorting on a
+    # property pinned by an equality filter is a no-op
+    order = (['number'] if number_range else []) + ['subject']
+    order = [prop for prop in order if prop not in equality]
+
+    projection = None
+    if fields is not None:
+        # Equality-filtered values are known already and can't be projected;
+        # sort properties must be projected for the index to serve the query
+        wanted = [f for f in COURSE_PROPERTIES if f in fields and f not in equality]
+        projection = wanted + [prop for prop in order if prop not in wanted] if wanted else []
+    return equality, number_range, order, projection
+
+
+def build_course_query(equality, number_range, order, projection):
+    """
+    Build a 'courses' query from a course_query_plan.
+    """
+    query = get_datastore_client().query(kind=COURSES_KIND)
+    for prop, value in equality.items():
+        query.add_filter(prop, '=', value)
+    if number_range:
+        query.add_filter('number', '>=', number_range[0])
+        query.add_filter('number', '<', number_range[1])
+    query.order = order
+    if projection == []:
+        query.keys_only()
+    elif projection:
+        query.projection = projection
+    return query
+
+
+def get_cached_courses_by_ids(course_ids):
+    """
+    Retrieve many 'courses' entities through course_cache, loading all the
+    misses with one chunked get_multi. Return {id: entity}; missing IDs are
+    left out.
+    """
+    def load(missing_ids):
+        courses = get_entities_by_ids(COURSES_KIND, missing_ids)
+        return {cid: course_to_cache(course) for cid, course in courses.items()}
+
+    values = course_cache.get_courses(course_ids, load)
+    return {cid: course_from_cache(value) for cid, value in values.items()}
+
+
+def url_template(endpoint, arg):
+    """
+    Return the (prefix, suffix) around the ID in endpoint's external URL,
+    e.g. ('http://host/courses/', ''). The host comes from the request, so
+    this runs url_for once per request and endpoint; serializers then build
+    each row's link by concatenation.
+    """
+    templates = g.setdefault('url_templates', {})
+    if endpoint not in templates:
+        url = url_for(endpoint, _external=True, **{arg: URL_ID_PLACEHOLDER})
+        templates[endpoint] = tuple(url.split(URL_ID_PLACEHOLDER, 1))
+    return templates[endpoint]
+
+
+class Serializer:
+    """
+    Turns rows of one kind (entities or cached dicts) into response dicts.
+    The field list is worked out once, not per row, and link fields are an
+    ID spliced into the request's url_template instead of a url_for call.
+    only(fields) returns the serializer for a fields= subset.
+    """
+    def __init__(self, properties, links=None, fields=None):
+        # links maps a response field to the (endpoint, ID argument) it points at
+        wanted = set(fields) if fields is not None else None
+        self.with_id = wanted is None or 'id' in wanted
+        self.properties = tuple(p for p in properties if wanted is None or p in wanted)
+        self.links = tuple((field, target) for field, target in (links or {}).items()
+                           if wanted is None or field in wanted)
+        self._all_properties = properties
+        self._all_links = links
+        self._subsets = {}
+
+    def only(self, fields):
+        if fields is None:
+            return self
+        key = tuple(fields)
+        subset = self._subsets.get(key)
+        if subset is None:
+            subset = self._subsets[key] = Serializer(self._all_properties, self._all_links, fields)
+        return subset
+
+    def many(self, rows):
+        """
+        Serialize (row_id, row) pairs, resolving link templates once.
+        """
+        links = [(field, url_template(*target)) for field, target in self.links]
+        properties = self.properties
+        with_id = self.with_id
+        result = []
+        for row_id, row in rows:
+            get = row.get
+            body = {"id": row_id} if with_id else {}
+            for prop in properties:
+                body[prop] = get(prop)
+            for field, (prefix, suffix) in links:
+                body[field] = f"{prefix}{row_id}{suffix}"
+            result.append(body)
+        return result
+
+    def __call__(self, row_id, row):
+        return self.many(((row_id, row),))[0]
+
+
+COURSE_SERIALIZER = Serializer(COURSE_PROPERTIES, links={"self": ('get_course', 'course_id')})
+USER_SERIALIZER = Serializer(('role', 'sub'))
+
+
+def course_response(course):
+    """
+    Build the JSON body for a 'courses' entity as the course routes return it.
+    """
+    return COURSE_SERIALIZER(entity_id(course), course)
+
+
+def json_array_response(items, serialize):
+    """
+    Stream a JSON array of serialize(item) for each item, encoding
+    JSON_STREAM_CHUNK items at a time, so a long list is never held in
+    memory as one encoded body.
+    """
+    def generate():
+        items_iter = iter(items)
+        opening = '['
+        while True:
+            chunk = serialize(islice(items_iter, JSON_STREAM_CHUNK))
+            if not chunk:
+                break
+            # Strip the chunk's own brackets and splice it into the one array
+            yield opening + app.json.dumps(chunk)[1:-1]
+            opening = ','
+        yield '[]' if opening == '[' else ']'
+
+    return Response(stream_with_context(generate()), mimetype=app.json.mimetype)
+
+
+def fetch_course_page(cursor, offset, limit, filters=None, fields=None):
+    """
+    Read one GET /courses page from Datastore, ordered by subject (by number,
+    then subject, under a number prefix filter), starting at cursor (or
+    skipping offset). Return (courses, next_cursor) where courses are dicts
+    holding the requested fields and next_cursor is None on the last page.
+    Projected pages fall back to full entities if no index serves them.
+    Raises ValueError or BadRequest for a malformed cursor or filter, and
+    FailedPrecondition if no declared index serves the filters.
+    """
+    equality, number_range, order, projection = course_query_plan(filters or {}, fields)
+
+    def run(projection):
+        query = build_course_query(equality, number_range, order, projection)
+        with backend_timer('datastore'):
+            if cursor:
+                iterator = query.fetch(start_cursor=cursor, limit=limit)
+            else:
+                iterator = query.fetch(offset=offset, limit=limit)
+            return iterator, list(next(iterator.pages))
+
+    try:
+        iterator, entities = run(projection)
+    except FailedPrecondition:
+        if not projection:
+            raise
+        projection = None
+        iterator, entities = run(projection)
+
+    courses = []
+    for entity in entities:
+        course = {"id": entity_id(entity)}
+        course.update(equality)
+        course.update({prop: entity.get(prop) for prop in COURSE_PROPERTIES if prop in entity})
+        courses.append(course)
+
+    # A full page may or may not be followed by more courses; probe with a
+    # one-key read of the same filters and order from the end cursor before
+    # reporting one
+    next_cursor = iterator.next_page_token
+    if len(courses) < limit or not next_cursor:
+        return courses, None
+    probe = build_course_query(equality, number_range, order, None)
+    probe.keys_only()
+    with backend_timer('datastore'):
+        more = list(probe.fetch(start_cursor=next_cursor, limit=1))
+    if not more:
+        return courses, None
+    return courses, next_cursor.decode('ascii')
+
+
+def enrollment_key(course_id, student_id):
+    """
+    Key of the 'enrollments' entity recording student_id in course_id.
+    The name is deterministic, so adding a student twice is a no-op.
+    """
+    return get_datastore_client().key(ENROLLMENTS_KIND, f"{int(course_id)}-{int(student_id)}")
+
+
+def ids_from_enrollment_key(key):
+    """
+    Return (course_id, student_id) from an 'enrollments' key name.
+    """
+    course_id, student_id = key.name.split('-', 1)
+    return int(course_id), int(student_id)
+
+
+def enrollment_chunks(course_id, add_ids, remove_ids):
+    """
+    Split a roster change in 'entity' mode into (add_ids, remove_ids,
+    entities to put, keys to delete) chunks small enough to commit in one
+    transaction alongside the course and its 'changes' entry.
+    """
+    # Two mutations per commit are left for the course and the change entry
+    chunk_size = WRITE_BATCH_SIZE - 2
+    ops = [(sid, True) for sid in sorted(add_ids)] + [(sid, False) for sid in sorted(remove_ids)]
+    # An empty change still yields one chunk, like list mode's single commit
+    for i in range(0, max(len(ops), 1), chunk_size):
+        chunk = ops[i:i + chunk_size]
+        chunk_adds = [sid for sid, added in chunk if added]
+        chunk_removes = [sid for sid, added in chunk if not added]
+        entities = []
+        for sid in chunk_adds:
+            entity = datastore.Entity(key=enrollment_key(course_id, sid))
+            entity.update({"course_id": int(course_id), "student_id": int(sid)})
+            entities.append(entity)
+        yield chunk_adds, chunk_removes, entities, [enrollment_key(course_id, sid) for sid in chunk_removes]
+
+
+def delete_enrollment_entities(course_id):
+    """
+    Delete every 'enrollments' entity of a course ('entity' mode).
+    """
+    query = get_datastore_client().query(kind=ENROLLMENTS_KIND)
+    query.add_filter('course_id', '=', int(course_id))
+    query.keys_only()
+    with backend_timer('datastore'):
+        keys = [e.key for e in query.fetch()]
+    for i in range(0, len(keys), WRITE_BATCH_SIZE):
+        with backend_timer('datastore'):
+            get_datastore_client().delete_multi(keys[i:i + WRITE_BATCH_SIZE])
+
+
+def fetch_enrollment_page(course_id, cursor, limit):
+    """
+    Read one page of a course's roster from 'enrollments', ordered by
+    student ID. Return (student_ids, next_cursor) where next_cursor is None
+    on the last page.
+    Raises ValueError or BadRequest for a malformed cursor.
+    """
+    def roster_query():
+        query = get_datastore_client().query(kind=ENROLLMENTS_KIND)
+        query.add_filter('course_id', '=', int(course_id))
+        query.order = ['student_id']
+        query.keys_only()
+        return query
+
+    with backend_timer('datastore'):
+        iterator = roster_query().fetch(start_cursor=cursor, limit=limit)
+        keys = [e.key for e in next(iterator.pages)]
+    student_ids = [ids_from_enrollment_key(key)[1] for key in keys]
+
+    # Same one-key probe as fetch_course_page, so a full last page doesn't
+    # advertise an empty next page
+    next_cursor = iterator.next_page_token
+    if len(student_ids) < limit or not next_cursor:
+        return student_ids, None
+    with backend_timer('datastore'):
+        more = list(roster_query().fetch(start_cursor=next_cursor, limit=1))
+    if not more:
+        return student_ids, None
+    return student_ids, next_cursor.decode('ascii')
+
+
+def get_student_course_ids(student_id):
+    """
+    Return the IDs of every course student_id is enrolled in, using
+    keys-only queries in either enrollment storage mode.
+    """
+    if ENROLLMENT_STORAGE == 'entity':
+        query = get_datastore_client().query(kind=ENROLLMENTS_KIND)
+        query.add_filter('student_id', '=', int(student_id))
+        query.keys_only()
+        with backend_timer('datastore'):
+            return [ids_from_enrollment_key(e.key)[0] for e in query.fetch()]
+
+    # 'students' is an indexed list property, so an equality filter
+    # matches courses whose roster contains student_id
+    query = get_datastore_client().query(kind=COURSES_KIND)
+    query.add_filter('students', '=', int(student_id))
+    query.keys_only()
+    with backend_timer('datastore'):
+        return [entity_id(c) for c in query.fetch()]
+
+
+def apply_roster_change(course_key, add_ids, remove_ids):
+    """
+    Enroll add_ids in and drop remove_ids from a course (sets of ints that
+    don't overlap), bump its roster_version and invalidate its cache entry.
+    Return False if the course no longer exists.
+    """
+    if ENROLLMENT_STORAGE == 'entity':
+        # One entity per membership: write only the students that changed.
+        # Each chunk commits together with a roster_version bump and its own
+        # 'changes' entry, so the feed records every write that lands and a
+        # reader never pairs the new version with the old roster.
+        found = True
+        for chunk_adds, chunk_removes, entities, removal_keys in enrollment_chunks(
+                course_key.id, add_ids, remove_ids):
+            def write_chunk():
+                current = get_datastore_client().get(course_key)
+                if not current:
+                    return False
+                bump_version(current, 'roster_version')
+                get_datastore_client().put_multi([
+                    current, change_entity('roster.update', course_key.id, add_ids=chunk_adds,
+                                           remove_ids=chunk_removes), *entities])
+                if removal_keys:
+                    get_datastore_client().delete_multi(removal_keys)
+                return True
+
+            if not run_in_transaction(write_chunk):
+                found = False
+                break
+    else:
+        def apply_enrollment():
+            # Re-read inside the transaction so concurrent edits aren't lost
+            current = get_datastore_client().get(course_key)
+            if not current:
+                return False
+            current_students = set(current.get('students', []))
+            current_students.update(add_ids)
+            current_students.difference_update(remove_ids)
+
+            # Stored as sorted ints so the student index filter in get_user matches
+            current['students'] = sorted(current_students)
+            bump_version(current, 'roster_version')
+            get_datastore_client().put_multi([
+                current, change_entity('roster.update', course_key.id, add_ids=add_ids,
+                                       remove_ids=remove_ids)])
+            return True
+
+        found = run_in_transaction(apply_enrollment)
+    # Rosters aren't part of the course pages, so those stay cached
+    course_cache.invalidate(course_key.id, pages=False)
+    return found
+
+
+def change_entity(op, course_id, course=None, add_ids=(), remove_ids=()):
+    """
+    Build a 'changes' entry: op is course.create, course.update,
+    course.delete or roster.update. Course ops carry a snapshot of the
+    course's properties; roster ops carry the added and removed student IDs.
+    Put it in the same transaction as the write it records.
+    """
+    name = f"{time.time_ns():020d}-{os.urandom(4).hex()}"
+    change = datastore.Entity(key=get_datastore_client().key(CHANGES_KIND, name),
+                              exclude_from_indexes=('op', 'course_id', 'course', 'add', 'remove'))
+    change.update({"op": op, "course_id": int(course_id)})
+    if course is not None:
+        change['course'] = {prop: course.get(prop) for prop in COURSE_PROPERTIES}
+    if op == 'roster.update':
+        change['add'] = sorted(add_ids)
+        change['remove'] = sorted(remove_ids)
+    return change
+
+
+def change_response(change):
+    """
+    Build the GET /changes item for a 'changes' entity.
+    """
+    course_id = change['course_id']
+    written_ns = int(change.key.name.split('-', 1)[0])
+    prefix, suffix = url_template('get_course', 'course_id')
+    response = {
+        "id": change.key.name,
+        "op": change['op'],
+        "course_id": course_id,
+        "at": datetime.fromtimestamp(written_ns / 1e9, timezone.utc).isoformat(),
+        "self": f"{prefix}{course_id}{suffix}"
+    }
+    if 'course' in change:
+        response['course'] = {prop: change['course'].get(prop) for prop in COURSE_PROPERTIES}
+    if 'add' in change:
+        response['add'] = list(change['add'])
+        response['remove'] = list(change.get('remove', []))
+    return response
+
+
+def fetch_pages(query, **fetch_args):
+    """
+    Yield a query's results a page at a time, timing each Datastore round
+    trip, so callers can walk a whole kind without holding it in memory.
+    """
+    pages = query.fetch(**fetch_args).pages
+    while True:
+        with backend_timer('datastore'):
+            page = next(pages, None)
+            if page is None:
+                return
+            entities = list(page)
+        yield entities
+
+
+def bulk_format(mimetype):
+    """
+    Pick the bulk import/export format: ?format=csv|ndjson if given, else
+    CSV when mimetype (the upload's Content-Type, or the best Accept match
+    for an export) is text/csv, else NDJSON. Exports only match CSV when the
+    client prefers text/csv over NDJSON, not for */*.
+    Raises ValueError for an unknown ?format=.
+    """
+    fmt = request.args.get('format')
+    if fmt is None:
+        return 'csv' if mimetype == BULK_FORMATS['csv'] else 'ndjson'
+    if fmt not in BULK_FORMATS:
+        raise ValueError(fmt)
+    return fmt
+
+
+def read_import_rows(fmt, required):
+    """
+    Parse the request body incrementally as CSV (with a header row) or
+    NDJSON (one object per line). Return an iterator of (line, row, error):
+    row is a dict, or None with an error message for a malformed record.
+    Raises ValueError if a CSV header lacks a required column.
+    """
+    text = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        if not set(required) <= set(reader.fieldnames or ()):
+            raise ValueError(reader.fieldnames)
+
+        def csv_rows():
+            for row in reader:
+                # Empty cells count as missing, like absent NDJSON keys
+                yield reader.line_num, {k: v for k, v in row.items() if v not in ('', None)}, None
+        return csv_rows()
+
+    def ndjson_rows():
+        for line, raw in enumerate(text, start=1):
+            if not raw.strip():
+                continue
+            try:
+                row = json.loads(raw)
+            except ValueError:
+                yield line, None, "Malformed JSON"
+                continue
+            if not isinstance(row, dict):
+                yield line, None, "Expected a JSON object"
+                continue
+            yield line, row, None
+    return ndjson_rows()
+
+
+def import_batches(rows):
+    """
+    Group import rows into lists of IMPORT_BATCH_SIZE for batched validation.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, IMPORT_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def reject_row(report, line, error):
+    """
+    Count a rejected import row, itemizing up to IMPORT_MAX_ERRORS of them.
+    """
+    report['failed'] += 1
+    if len(report['errors']) < IMPORT_MAX_ERRORS:
+        report['errors'].append({"line": line, "Error": error})
+
+
+def export_response(rows, columns, fmt, filename):
+    """
+    Stream rows (dicts) as CSV with a header row or as NDJSON, encoding
+    EXPORT_CHUNK_ROWS rows per chunk so memory doesn't grow with the export.
+    """
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == 'csv':
+            writer.writerow(columns)
+        for count, row in enumerate(rows, start=1):
+            if fmt == 'csv':
+                writer.writerow([row.get(c) for c in columns])
+            else:
+                buffer.write(json.dumps({c: row.get(c) for c in columns}) + "\n")
+            if count % EXPORT_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    response = Response(stream_with_context(generate()), mimetype=BULK_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    return response
+
+
+def set_avatar_generation(user_entity, generation):
+    """
+    Record the GCS generation of the user's avatar (None once deleted) on
+    their 'users' entity, so profile reads can tell whether an avatar exists
+    without asking GCS.
+    """
+    def update():
+        user = get_datastore_client().get(user_entity.key)
+        if user is None:
+            return
+        user['avatar_generation'] = generation
+        get_datastore_client().put(user)
+
+    run_in_transaction(update)
+    invalidate_user_cache(user_entity.get('sub'))
+
+
+@app.route('/_ah/warmup')
+def warmup():
+    """
+    GET /_ah/warmup
+    App Engine warmup request. Creates the backend clients and primes the
+    JWKS key store so the first real request doesn't pay for them.
+    """
+    get_datastore_client()
+    get_storage_client()
+    try:
+        jwks_store.refresh()
+    except Exception as e:
+        print("Warmup could not prime JWKS:", e)
+    startup_report["warmed_up"] = True
+    return jsonify(startup_report), 200
+
 
 @app.route('/')
 def hello_world():
     return "Hello, World! This is the Tarpaulin API, written by saakiyama02@gmail.com."
 
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.backend_timings = {}
+    g.profiler = None
+    if SLOW_REQUEST_PROFILE_MS > 0:
+        g.profiler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+        g.profiler.start()
+
+
+def shed_response(status_code, error, retry_after):
+    """
+    Build the fast 429 / 503 answer for a request turned away by admission
+    control, with a Retry-After of at least a second.
+    """
+    response = jsonify({"Error": error})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+@app.before_request
+def admit_request():
+    """
+    Apply the per-sub rate limit, then the route's concurrency limit, before
+    the handler runs. Returns a 429 or 503 response to shed the request.
+    """
+    g.admission = None
+    if sub_buckets is not None and 'Authorization' in request.headers:
+        # Verified tokens are cached, so the handler's own check stays cheap
+        try:
+            sub = verify_jwt(request).get('sub')
+        except AuthError:
+            sub = None  # the handler reports the bad token
+        if sub:
+            wait = sub_buckets.take(sub)
+            if wait:
+                return shed_response(429, "Too many requests", wait)
+
+    limiter = route_limiters.get(request.endpoint)
+    if limiter is not None:
+        queued = limiter.acquire()
+        if queued is None:
+            return shed_response(503, "The server is busy; retry shortly", ADMISSION_RETRY_AFTER)
+        admission_wait.observe((request.endpoint,), queued)
+        g.admission = limiter
+
+
+@app.teardown_request
+def release_admission(exc):
+    # Runs after a streamed body finishes, so exports hold their slot throughout
+    limiter = g.pop('admission', None)
+    if limiter is not None:
+        limiter.release()
+
+
+@app.after_request
+def record_request_timing(response):
+    """
+    Add a Server-Timing header with per-backend time, record the request in
+    the /metrics histograms and dump a profile if the request was slow.
+    """
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    parts = [f'{backend};desc="{count} calls";dur={total * 1000:.1f}'
+             for backend, (total, count) in sorted(g.backend_timings.items())]
+    parts.append(f"app;dur={elapsed * 1000:.1f}")
+    response.headers['Server-Timing'] = ", ".join(parts)
+
+    if startup_report["first_response_seconds"] is None:
+        startup_report["first_response_seconds"] = time.perf_counter() - _IMPORT_STARTED
+        print(f"Startup: import took {startup_report['import_seconds']:.3f}s, first response "
+              f"{startup_report['first_response_seconds']:.3f}s after import started")
+
+    route = request.endpoint or 'none'
+    request_duration.observe((route, request.method, str(response.status_code)), elapsed)
+
+    if g.profiler is not None:
+        g.profiler.stop()
+        if elapsed * 1000 >= SLOW_REQUEST_PROFILE_MS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{route}-{elapsed * 1000:.0f}ms.folded")
+            g.profiler.dump(path)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    GET /metrics
+    Unprotected. Request, backend and admission-queue latency histograms plus
+    cache, coalescing and admission counters in Prometheus text format.
+    """
+    lines = request_duration.render() + backend_duration.render() + admission_wait.render()
+    cache_stats = {
+        "tokens": token_cache.stats(),
+        "identities": user_cache.stats(),
+        "courses": course_cache.stats()
+    }
+    for name, value in (("tarpaulin_startup_import_seconds", startup_report["import_seconds"]),
+                        ("tarpaulin_startup_first_response_seconds",
+                         startup_report["first_response_seconds"])):
+        if value is not None:
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    for metric in ('hits', 'misses'):
+        name = f"tarpaulin_cache_{metric}_total"
+        lines.append(f"# TYPE {name} counter")
+        for cache, stats in cache_stats.items():
+            lines.append(f'{name}{{cache="{cache}"}} {stats[metric]}')
+    for metric in ('calls', 'shared', 'timeouts'):
+        name = f"tarpaulin_single_flight_{metric}_total"
+        lines.append(f"# TYPE {name} counter")
+        for flight in flights:
+            lines.append(f'{name}{{flight="{flight.name}"}} {flight.stats()[metric]}')
+    admission = {route: limiter.stats() for route, limiter in sorted(route_limiters.items())}
+    for metric, kind in (('active', 'gauge'), ('waiting', 'gauge'), ('admitted', 'counter')):
+        name = f"tarpaulin_admission_{metric}" + ("_total" if kind == 'counter' else "")
+        lines.append(f"# TYPE {name} {kind}")
+        for route, stats in admission.items():
+            lines.append(f'{name}{{route="{route}"}} {stats[metric]}')
+    lines.append("# TYPE tarpaulin_admission_shed_total counter")
+    for route, stats in admission.items():
+        for reason in ('queue_full', 'timeout'):
+            lines.append(f'tarpaulin_admission_shed_total{{route="{route}",reason="{reason}"}} '
+                         f'{stats["shed_" + reason]}')
+    if sub_buckets is not None:
+        lines.append("# TYPE tarpaulin_rate_limited_total counter")
+        lines.append(f"tarpaulin_rate_limited_total {sub_buckets.stats()['limited']}")
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/stats/cache', methods=['GET'])
+def get_cache_stats():
+    """
+    GET /stats/cache
+    Admin only. Returns size, hit/miss counts and staleness bounds per cache,
+    plus request coalescing counts and admission control (per-route slots,
+    queues and sheds; per-sub rate limiting, or null when disabled).
+    """
+    payload, calling_user = require_auth_and_get_user(request)
+    check_admin(calling_user)
+
+    return jsonify({
+        "tokens": token_cache.stats(),
+        "identities": user_cache.stats(),
+        "courses": course_cache.stats(),
+        "single_flight": {flight.name: flight.stats() for flight in flights},
+        "admission": {route: limiter.stats() for route, limiter in route_limiters.items()},
+        "rate_limit": sub_buckets.stats() if sub_buckets is not None else None
+    }), 200
+
+
 @app.route('/users/login', methods=['POST'])
 def login_user():
     """
@@ -221,8 +2108,9 @@ def login_user():
         'scope': 'openid'  # Request id_token
     }
     headers = {'content-type': 'application/json'}
-    url = f'https://{DOMAIN}/oauth/token'
-    r = requests.post(url, json=body, headers=headers)
+    url = f'{AUTH0_BASE_URL}/oauth/token'
+    with backend_timer('auth0'):
+        r = get_auth0_session().post(url, json=body, headers=headers, timeout=AUTH0_TIMEOUT)
 
     if r.status_code == 200:
         token_response = r.json()
@@ -236,25 +2124,114 @@ def login_user():
         return jsonify({"Error": "Unauthorized"}), 401
 
 
+def user_response(target_user):
+    """
+    Build the GET /users/<id> body for a 'users' entity: id, role, sub, plus
+    avatar_url and the course URLs where they apply.
+    """
+    user_id = entity_id(target_user)
+    response = USER_SERIALIZER(user_id, target_user)
+
+    # Include avatar_url if the user entity records an uploaded avatar
+    if target_user.get('avatar_generation') is not None:
+        prefix, suffix = url_template('get_user_avatar', 'user_id')
+        response['avatar_url'] = f"{prefix}{user_id}{suffix}"
+
+    # Include courses if role is instructor or student
+    role = target_user.get('role')
+    if role in ['instructor', 'student']:
+        courses_list = []
+        prefix, suffix = url_template('get_course', 'course_id')
+        if role == 'instructor':
+            # Keys-only query for courses where instructor_id == user_id;
+            # the links only need the IDs
+            query = get_datastore_client().query(kind=COURSES_KIND)
+            query.add_filter('instructor_id', '=', int(user_id))
+            query.keys_only()
+            with backend_timer('datastore'):
+                courses = list(query.fetch())
+            for c in courses:
+                courses_list.append(f"{prefix}{entity_id(c)}{suffix}")
+        else:  # student
+            for course_id in get_student_course_ids(user_id):
+                courses_list.append(f"{prefix}{course_id}{suffix}")
+        response['courses'] = courses_list
+
+    return response
+
+
 @app.route('/users', methods=['GET'])
 def get_all_users():
     """
     GET /users
     Admin only. Returns list of all users: [ { id, role, sub }, ... ]
+    Paged by cursor & limit (up to USERS_PAGE_SIZE); a Link: rel="next"
+    header points at the next page.
+    With ?ids=1,2,3, returns those users instead (see get_users_batch).
     """
     payload, calling_user = require_auth_and_get_user(request)
+    if 'ids' in request.args:
+        return get_users_batch(payload, calling_user)
     check_admin(calling_user)
 
-    query = datastore_client.query(kind=USERS_KIND)
-    users = list(query.fetch())
+    cursor = request.args.get('cursor')
+    try:
+        limit = int(request.args.get('limit', USERS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+    if limit < 1:
+        return jsonify({"Error": "The request body is invalid"}), 400
+    limit = min(limit, USERS_PAGE_SIZE)
+
+    try:
+        users, next_cursor = fetch_user_page(cursor, limit)
+    except (ValueError, BadRequest):
+        return jsonify({"Error": "The request body is invalid"}), 400
+    response = json_array_response(users, lambda chunk: USER_SERIALIZER.many((entity_id(u), u) for u in chunk))
+    if next_cursor:
+        next_url = url_for('get_all_users', cursor=next_cursor, limit=limit, _external=True)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response, 200
+
+
+def get_users_batch(payload, calling_user):
+    """
+    GET /users?ids=1,2,3
+    Return each listed user as GET /users/<id> would, in request order,
+    fetched with one get_multi. Each item gets the single-user permission
+    check (admin or the user themselves); items that fail it, or don't
+    exist, get an error marker instead.
+    """
+    try:
+        user_ids = parse_batch_ids(request.args['ids'])
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    denied = {}
+    for uid in user_ids:
+        try:
+            check_owner_or_admin(payload, calling_user, uid)
+        except AuthError as e:
+            denied[uid] = e.error
+    # Only read the users the caller may see
+    users = get_users_by_ids(uid for uid in user_ids if uid not in denied)
+
     response = []
-    for u in users:
-        response.append({
-            "id": u.key.id,
-            "role": u.get('role'),
-            "sub": u.get('sub')
-        })
-    return jsonify(response), 200
+    for uid in user_ids:
+        if uid in denied:
+            response.append({"id": uid, **denied[uid]})
+            continue
+        if uid not in users:
+            response.append({"id": uid, "Error": "Not found"})
+            continue
+        response.append(uid)
+
+    # Each user's course lookup is its own query; run them side by side
+    bodies = run_concurrently(*(lambda u=users[uid]: user_response(u)
+                                for uid in dict.fromkeys(r for r in response if isinstance(r, int))))
+    bodies = {body['id']: body for body in bodies}
+    response = [bodies[r] if isinstance(r, int) else r for r in response]
+    return jsonify({"users": response}), 200
 
 
 @app.route('/users/<user_id>', methods=['GET'])
@@ -263,45 +2240,17 @@ def get_user(user_id):
     GET /users/<user_id>
     Admin or user themselves. Returns user details with optional avatar_url and courses.
     """
-    payload, calling_user = require_auth_and_get_user(request)
-    target_user = get_user_by_id(user_id)
+    # The identity lookup and the target read don't depend on each other
+    (payload, calling_user), target_user = run_concurrently(
+        lambda: require_auth_and_get_user(request),
+        lambda: get_user_by_id(user_id)
+    )
     if not target_user:
         raise AuthError({"Error": "Not found"}, 403)
 
     check_owner_or_admin(payload, calling_user, user_id)
 
-    response = {
-        "id": target_user.key.id,
-        "role": target_user.get('role'),
-        "sub": target_user.get('sub')
-    }
-
-    # Check and include avatar_url if exists
-    blob_name = f"avatars/{user_id}.png"
-    if check_blob_exists(AVATAR_BUCKET, blob_name):
-        avatar_url = url_for('get_user_avatar', user_id=user_id, _external=True)
-        response['avatar_url'] = avatar_url
-
-    # Include courses if role is instructor or student
-    role = target_user.get('role')
-    if role in ['instructor', 'student']:
-        courses_list = []
-        if role == 'instructor':
-            # Query courses where instructor_id == user_id
-            query = datastore_client.query(kind=COURSES_KIND)
-            query.add_filter('instructor_id', '=', int(user_id))
-            for c in query.fetch():
-                courses_list.append(url_for('get_course', course_id=c.key.id, _external=True))
-        else:  # student
-            # Query all courses and include those where user_id in course['students']
-            query = datastore_client.query(kind=COURSES_KIND)
-            for c in query.fetch():
-                students = c.get('students', [])
-                if int(user_id) in students:
-                    courses_list.append(url_for('get_course', course_id=c.key.id, _external=True))
-        response['courses'] = courses_list
-
-    return jsonify(response), 200
+    return jsonify(user_response(target_user)), 200
 
 
 @app.route('/users/<user_id>/avatar', methods=['POST'])
@@ -322,9 +2271,11 @@ def create_or_update_avatar(user_id):
         return jsonify({"Error": "The request body is invalid"}), 400
 
     blob_name = f"avatars/{user_id}.png"
-    bucket = storage_client.bucket(AVATAR_BUCKET)
+    bucket = get_storage_client().bucket(AVATAR_BUCKET)
     blob = bucket.blob(blob_name)
-    blob.upload_from_file(file, content_type='image/png')
+    with backend_timer('gcs'):
+        blob.upload_from_file(file, content_type='image/png')
+    set_avatar_generation(calling_user, blob.generation)
 
     avatar_url = url_for('get_user_avatar', user_id=user_id, _external=True)
     return jsonify({"avatar_url": avatar_url}), 200
@@ -334,24 +2285,84 @@ def create_or_update_avatar(user_id):
 def get_user_avatar(user_id):
     """
     GET /users/<user_id>/avatar
-    Owner only. Returns avatar file or 404 if not exists.
+    Owner only. Streams avatar file or 404 if not exists.
+    Honors If-None-Match / If-Modified-Since (304) and single Range requests (206).
     """
     payload, calling_user = require_auth_and_get_user(request)
     check_owner(payload, calling_user, user_id)
 
     blob_name = f"avatars/{user_id}.png"
-    bucket = storage_client.bucket(AVATAR_BUCKET)
-    blob = bucket.blob(blob_name)
-    if not blob.exists():
+    bucket = get_storage_client().bucket(AVATAR_BUCKET)
+
+    def load_metadata():
+        # A single metadata read doubles as the existence check
+        blob = bucket.blob(blob_name)
+        try:
+            with backend_timer('gcs'):
+                blob.reload()
+        except NotFound:
+            return None
+        return {"generation": blob.generation, "etag": blob.etag,
+                "updated": blob.updated, "size": blob.size}
+
+    metadata = blob_flight.do(('metadata', AVATAR_BUCKET, blob_name), load_metadata)
+    if metadata is None:
         return jsonify({"Error": "Not found"}), 404
 
-    img_bytes = blob.download_as_bytes()
-    return send_file(
-        BytesIO(img_bytes),
-        mimetype='image/png',
-        as_attachment=False,
-        attachment_filename=f"{user_id}.png"
-    ), 200
+    # Pinning the generation keeps every chunk on the object version the ETag describes
+    blob = bucket.blob(blob_name, generation=metadata['generation'])
+    etag = metadata['etag']
+    last_modified = metadata['updated']
+    size = metadata['size']
+
+    # Conditional GET: answer from metadata without downloading the image
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = (request.if_modified_since is not None and last_modified is not None
+                        and last_modified.replace(microsecond=0) <= request.if_modified_since)
+    if not_modified:
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+
+    # Single byte range; If-Range must name the current ETag to apply it
+    start, stop = 0, size
+    status = 200
+    byte_range = request.range
+    if (byte_range is not None and len(byte_range.ranges) == 1
+            and ('If-Range' not in request.headers or request.if_range.etag == etag)):
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{size}"
+            return response
+        start, stop = bounds
+        status = 206
+
+    def generate():
+        # Ranged media reads on the pinned blob: the metadata above already
+        # gave the size, so no chunk needs another metadata round trip
+        offset = start
+        while offset < stop:
+            end = min(offset + AVATAR_CHUNK_SIZE, stop)
+            with backend_timer('gcs'):
+                chunk = blob.download_as_bytes(start=offset, end=end - 1)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    response = Response(stream_with_context(generate()), status=status, mimetype='image/png', direct_passthrough=True)
+    response.content_length = stop - start
+    response.accept_ranges = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Content-Disposition'] = f'inline; filename="{user_id}.png"'
+    if status == 206:
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    return response
 
 
 @app.route('/users/<user_id>/avatar', methods=['DELETE'])
@@ -364,12 +2375,15 @@ def delete_user_avatar(user_id):
     check_owner(payload, calling_user, user_id)
 
     blob_name = f"avatars/{user_id}.png"
-    bucket = storage_client.bucket(AVATAR_BUCKET)
+    bucket = get_storage_client().bucket(AVATAR_BUCKET)
     blob = bucket.blob(blob_name)
-    if not blob.exists():
+    try:
+        with backend_timer('gcs'):
+            blob.delete()
+    except NotFound:
         return jsonify({"Error": "Not found"}), 404
 
-    blob.delete()
+    set_avatar_generation(calling_user, None)
     return '', 204
 
 
@@ -393,7 +2407,10 @@ def create_course():
     if not instructor or instructor.get('role') != 'instructor':
         return jsonify({"Error": "The request body is invalid"}), 400
 
-    new_course_key = datastore_client.key(COURSES_KIND)
+    # The ID is allocated up front so the change entry can name the course
+    # and both land in one transaction
+    with backend_timer('datastore'):
+        new_course_key = get_datastore_client().allocate_ids(get_datastore_client().key(COURSES_KIND), 1)[0]
     new_course = datastore.Entity(key=new_course_key)
     new_course.update({
         "subject": content['subject'],
@@ -401,60 +2418,123 @@ def create_course():
         "title": content['title'],
         "term": content['term'],
         "instructor_id": int(instructor_id),
-        "students": []
+        "version": 1,
+        "roster_version": 1
     })
-    datastore_client.put(new_course)
+    new_course.exclude_from_indexes.update(('version', 'roster_version'))
+    if ENROLLMENT_STORAGE == 'list':
+        new_course['students'] = []
+    run_in_transaction(lambda: get_datastore_client().put_multi(
+        [new_course, change_entity('course.create', new_course_key.id, new_course)]))
+    course_cache.invalidate()
 
-    course_id = new_course.key.id
-    response_body = {
-        "id": course_id,
-        "instructor_id": new_course['instructor_id'],
-        "number": new_course['number'],
-        "self": url_for('get_course', course_id=course_id, _external=True),
-        "subject": new_course['subject'],
-        "term": new_course['term'],
-        "title": new_course['title']
-    }
-    return jsonify(response_body), 201
+    return jsonify(course_response(new_course)), 201
 
 
 @app.route('/courses', methods=['GET'])
 def get_all_courses():
     """
     GET /courses
-    Unprotected. Paginated by offset & limit (limit=3), sorted by subject.
+    Unprotected. Paginated by cursor (or legacy offset) & limit (limit=3),
+    sorted by subject. Optional filters: term, subject, instructor_id and
+    number (a course number prefix). fields=a,b,... returns only those fields.
     """
+    if 'ids' in request.args:
+        return get_courses_batch()
+
     # Default pagination parameters
+    cursor = request.args.get('cursor')
     try:
         offset = int(request.args.get('offset', 0))
-        limit = int(request.args.get('limit', 3))
+        limit = int(request.args.get('limit', COURSES_PAGE_SIZE))
     except ValueError:
         return jsonify({"Error": "The request body is invalid"}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({"Error": "The request body is invalid"}), 400
+    limit = min(limit, COURSES_MAX_PAGE_SIZE)
 
-    query = datastore_client.query(kind=COURSES_KIND)
-    query.order = ['subject']
-    courses = list(query.fetch(offset=offset, limit=limit + 1))  # fetch one extra to check next
+    filters = {name: request.args[name] for name in COURSE_FILTERS if name in request.args}
+    try:
+        fields = parse_course_fields(request.args.get('fields'))
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
 
-    response_courses = []
-    for idx, c in enumerate(courses[:limit]):
-        response_courses.append({
-            "id": c.key.id,
-            "instructor_id": c.get('instructor_id'),
-            "number": c.get('number'),
-            "self": url_for('get_course', course_id=c.key.id, _external=True),
-            "subject": c.get('subject'),
-            "term": c.get('term'),
-            "title": c.get('title')
-        })
-
-    response_body = {"courses": response_courses}
-    # If there's an extra entry beyond limit, build next link
-    if len(courses) > limit:
-        next_offset = offset + limit
-        next_url = url_for('get_all_courses', offset=next_offset, limit=limit, _external=True)
+    def load_page():
+        courses, next_cursor = fetch_course_page(cursor, offset, limit, filters, fields)
+        return {"courses": courses, "next_cursor": next_cursor}
+
+    page_args = (cursor or '', offset, limit,
+                 *(f"{name}={filters.get(name, '')}" for name in COURSE_FILTERS),
+                 ",".join(fields or []))
+    try:
+        page = course_cache.get_page(page_args, load_page)
+    except (ValueError, BadRequest):
+        return jsonify({"Error": "The request body is invalid"}), 400
+    except FailedPrecondition:
+        return jsonify({"Error": "This combination of filters is not supported"}), 400
+
+    serializer = COURSE_SERIALIZER.only(fields)
+    response_body = {"courses": serializer.many((c['id'], c) for c in page['courses'])}
+    # If there are more courses beyond this page, build next link
+    next_cursor = page['next_cursor']
+    if next_cursor:
+        query_args = dict(filters)
+        if fields is not None:
+            query_args['fields'] = ",".join(fields)
+        if COURSES_NEXT_LINK == 'offset' and not cursor:
+            next_url = url_for('get_all_courses', offset=offset + limit, limit=limit,
+                               **query_args, _external=True)
+        else:
+            next_url = url_for('get_all_courses', cursor=next_cursor, limit=limit,
+                               **query_args, _external=True)
         response_body['next'] = next_url
 
-    return jsonify(response_body), 200
+    # Pages have no single version to key on, so hash the body for a weak ETag;
+    # an unchanged page still skips the transfer
+    response = jsonify(response_body)
+    etag = hashlib.sha256(response.get_data()).hexdigest()[:32]
+    cached = not_modified(etag, weak=True)
+    if cached:
+        return cached
+    response.set_etag(etag, weak=True)
+    return response, 200
+
+
+def parse_course_fields(raw):
+    """
+    Parse a fields=a,b,... value into a sorted list of course fields, or
+    None when absent. Raises ValueError for an unknown or empty field list.
+    """
+    if raw is None:
+        return None
+    fields = sorted({f.strip() for f in raw.split(',') if f.strip()})
+    if not fields or any(f not in COURSE_FIELDS for f in fields):
+        raise ValueError(raw)
+    return fields
+
+
+def get_courses_batch():
+    """
+    GET /courses?ids=1,2,3
+    Unprotected. Return the listed courses in request order with one
+    get_multi for any not already cached; unknown IDs get a not-found marker.
+    Honors fields= like the paged listing.
+    """
+    try:
+        course_ids = parse_batch_ids(request.args['ids'])
+        fields = parse_course_fields(request.args.get('fields'))
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    courses = get_cached_courses_by_ids(course_ids)
+    serializer = COURSE_SERIALIZER.only(fields)
+    response_courses = []
+    for cid in course_ids:
+        if cid not in courses:
+            response_courses.append({"id": cid, "Error": "Not found"})
+            continue
+        response_courses.append(serializer(cid, courses[cid]))
+    return jsonify({"courses": response_courses}), 200
 
 
 @app.route('/courses/<course_id>', methods=['GET'])
@@ -463,20 +2543,19 @@ def get_course(course_id):
     GET /courses/<course_id>
     Unprotected. Return course info or 404.
     """
-    course = get_course_by_id(course_id)
-    if not course:
+    value = get_cached_course_value(course_id)
+    if not value:
         return jsonify({"Error": "Not found"}), 404
 
-    response_body = {
-        "id": course.key.id,
-        "instructor_id": course.get('instructor_id'),
-        "number": course.get('number'),
-        "self": url_for('get_course', course_id=course.key.id, _external=True),
-        "subject": course.get('subject'),
-        "term": course.get('term'),
-        "title": course.get('title')
-    }
-    return jsonify(response_body), 200
+    # Pollers revalidating an unchanged course get a 304 straight from the cache
+    etag = course_etag(value)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    response = jsonify(course_response(course_from_cache(value)))
+    response.set_etag(etag)
+    return response, 200
 
 
 @app.route('/courses/<course_id>', methods=['PATCH'])
@@ -488,35 +2567,52 @@ def update_course(course_id):
     payload, calling_user = require_auth_and_get_user(request)
     check_admin(calling_user)
 
-    course = get_course_by_id(course_id)
+    # Read a new instructor alongside the course rather than after it. Only
+    # a well-formed ID is prefetched; anything else is left to the checks
+    # below, so the response is decided in the usual order
+    body = request.get_json(silent=True)
+    new_instructor = None
+    try:
+        instructor_id = int(body['instructor_id'])
+    except (TypeError, ValueError, KeyError):
+        course = get_course_by_id(course_id)
+    else:
+        course, new_instructor = run_concurrently(
+            lambda: get_course_by_id(course_id),
+            lambda: get_user_by_id(instructor_id)
+        )
     if not course:
         raise AuthError({"Error": "Not found"}, 403)
 
     content = request.get_json()
     # Validate instructor_id if present
     if 'instructor_id' in content:
-        new_instructor = get_user_by_id(content['instructor_id'])
         if not new_instructor or new_instructor.get('role') != 'instructor':
             return jsonify({"Error": "The request body is invalid"}), 400
-        course['instructor_id'] = int(content['instructor_id'])
 
-    # Update other fields if present
-    for field in ['subject', 'number', 'title', 'term']:
-        if field in content:
-            course[field] = content[field]
+    def apply_update():
+        # Re-read inside the transaction so the version bump can't be lost
+        current = get_datastore_client().get(course.key)
+        if not current:
+            raise AuthError({"Error": "Not found"}, 403)
+        if 'instructor_id' in content:
+            current['instructor_id'] = int(content['instructor_id'])
 
-    datastore_client.put(course)
+        # Update other fields if present
+        for field in ['subject', 'number', 'title', 'term']:
+            if field in content:
+                current[field] = content[field]
 
-    response_body = {
-        "id": course.key.id,
-        "instructor_id": course.get('instructor_id'),
-        "number": course.get('number'),
-        "self": url_for('get_course', course_id=course.key.id, _external=True),
-        "subject": course.get('subject'),
-        "term": course.get('term'),
-        "title": course.get('title')
-    }
-    return jsonify(response_body), 200
+        bump_version(current, 'version')
+        get_datastore_client().put_multi([current, change_entity('course.update', current.key.id, current)])
+        return current
+
+    course = run_in_transaction(apply_update)
+    course_cache.invalidate(course.key.id)
+
+    response = jsonify(course_response(course))
+    response.set_etag(course_etag(course_to_cache(course)))
+    return response, 200
 
 
 @app.route('/courses/<course_id>', methods=['DELETE'])
@@ -532,8 +2628,19 @@ def delete_course(course_id):
     if not course:
         raise AuthError({"Error": "Not found"}, 403)
 
-    # Delete course entity
-    datastore_client.delete(course.key)
+    def delete_entity():
+        def delete_and_record():
+            get_datastore_client().delete(course.key)
+            get_datastore_client().put(change_entity('course.delete', course.key.id))
+
+        run_in_transaction(delete_and_record)
+
+    # Delete course entity (and its enrollments, side by side)
+    if ENROLLMENT_STORAGE == 'entity':
+        run_concurrently(delete_entity, lambda: delete_enrollment_entities(course.key.id))
+    else:
+        delete_entity()
+    course_cache.invalidate(course.key.id)
     return '', 204
 
 
@@ -545,7 +2652,26 @@ def update_course_enrollment(course_id):
     Request JSON: { "add": [ids], "remove": [ids] }
     """
     payload, calling_user = require_auth_and_get_user(request)
-    course = get_course_by_id(course_id)
+
+    # When the body is well formed and the caller could pass the permission
+    # check, validate its student IDs alongside the course read; the checks
+    # below still run in their usual order. The prefetch is capped at one
+    # get_multi, so a caller who is then refused can't make it costly.
+    prefetched = None
+    prefetch_ids = None
+    if calling_user.get('role') in ('admin', 'instructor'):
+        body = request.get_json(silent=True)
+        try:
+            prefetch_ids = {int(sid) for sid in body['add'] + body['remove']}
+        except (TypeError, ValueError, KeyError):
+            pass
+    if not prefetch_ids or len(prefetch_ids) > GET_MULTI_BATCH_SIZE:
+        course = get_course_by_id(course_id)
+    else:
+        course, prefetched = run_concurrently(
+            lambda: get_course_by_id(course_id),
+            lambda: get_users_by_ids(prefetch_ids)
+        )
     if not course:
         raise AuthError({"Error": "Not found"}, 403)
 
@@ -565,22 +2691,23 @@ def update_course_enrollment(course_id):
     if intersection:
         return jsonify({"Error": "Enrollment data is invalid"}), 409
 
-    # Validate all IDs in add_list and remove_list are existing students
-    for sid in set(add_list + remove_list):
-        student = get_user_by_id(sid)
-        if not student or student.get('role') != 'student':
-            return jsonify({"Error": "Enrollment data is invalid"}), 409
-
-    current_students = set(course.get('students', []))
-    # Add students
-    for sid in add_list:
-        current_students.add(int(sid))
-    # Remove students
-    for sid in remove_list:
-        current_students.discard(int(sid))
-
-    course['students'] = list(current_students)
-    datastore_client.put(course)
+    # Validate all IDs in add_list and remove_list in one batched lookup,
+    # reporting every invalid ID at once
+    try:
+        student_ids = {int(sid) for sid in add_list + remove_list}
+    except (TypeError, ValueError):
+        return jsonify({"Error": "Enrollment data is invalid"}), 409
+    students = prefetched if prefetched is not None else get_users_by_ids(student_ids)
+    invalid_ids = sorted(
+        sid for sid in student_ids
+        if sid not in students or students[sid].get('role') != 'student'
+    )
+    if invalid_ids:
+        return jsonify({"Error": "Enrollment data is invalid", "invalid_ids": invalid_ids}), 409
+
+    if not apply_roster_change(course.key, {int(sid) for sid in add_list},
+                               {int(sid) for sid in remove_list}):
+        raise AuthError({"Error": "Not found"}, 403)
     return '', 200
 
 
@@ -588,10 +2715,12 @@ def update_course_enrollment(course_id):
 def get_course_enrollment(course_id):
     """
     GET /courses/<course_id>/students
-    Admin or course instructor. Return list of student IDs.
+    Admin or course instructor. Return list of student IDs, sorted.
+    Paged by cursor & limit in 'entity' storage mode, or when limit is
+    passed; a Link: rel="next" header points at the next page.
     """
     payload, calling_user = require_auth_and_get_user(request)
-    course = get_course_by_id(course_id)
+    course = get_cached_course_value(course_id)
     if not course:
         raise AuthError({"Error": "Not found"}, 403)
 
@@ -599,9 +2728,367 @@ def get_course_enrollment(course_id):
     if calling_user.get('role') != 'admin' and course.get('instructor_id') != calling_user.key.id:
         raise AuthError({"Error": "You don't have permission on this resource"}, 403)
 
-    students = course.get('students', [])
-    return jsonify(students), 200
+    cursor = request.args.get('cursor')
+    try:
+        limit = request.args.get('limit')
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+    if limit is not None and limit < 1:
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    # An unchanged roster is answered from the cached roster_version alone
+    etag = roster_etag(course)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    if ENROLLMENT_STORAGE == 'entity':
+        limit = min(limit or ENROLLMENT_PAGE_SIZE, ENROLLMENT_PAGE_SIZE)
+        try:
+            students, next_cursor = fetch_enrollment_page(course['id'], cursor, limit)
+        except (ValueError, BadRequest):
+            return jsonify({"Error": "The request body is invalid"}), 400
+    else:
+        # Lists written before rosters were kept sorted are in set order
+        students = sorted(course.get('students') or [])
+        next_cursor = None
+        if limit is not None or cursor:
+            # The cursor is simply the last ID served
+            limit = min(limit or ENROLLMENT_PAGE_SIZE, ENROLLMENT_PAGE_SIZE)
+            try:
+                start = bisect.bisect_right(students, int(cursor)) if cursor else 0
+            except ValueError:
+                return jsonify({"Error": "The request body is invalid"}), 400
+            page = students[start:start + limit]
+            if start + limit < len(students):
+                next_cursor = str(page[-1])
+            students = page
+
+    response = jsonify(students)
+    response.set_etag(etag)
+    if next_cursor:
+        next_url = url_for('get_course_enrollment', course_id=course['id'],
+                           cursor=next_cursor, limit=limit, _external=True)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response, 200
+
+
+@app.route('/courses/export', methods=['GET'])
+def export_courses():
+    """
+    GET /courses/export
+    Unprotected. Streams the course catalog (id, instructor_id, number,
+    subject, term, title) as CSV or NDJSON (?format=, else the Accept
+    header), ordered like GET /courses and taking the same filters.
+    """
+    filters = {name: request.args[name] for name in COURSE_FILTERS if name in request.args}
+    try:
+        fmt = bulk_format(request.accept_mimetypes.best_match(BULK_FORMATS.values()))
+        plan = course_query_plan(filters, None)
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    # Run the first query before streaming starts, so an unindexed filter
+    # combination is still a 400 rather than a broken download
+    pages = fetch_pages(build_course_query(*plan))
+    try:
+        first = next(pages, [])
+    except FailedPrecondition:
+        return jsonify({"Error": "This combination of filters is not supported"}), 400
+
+    def rows():
+        for page in chain([first], pages):
+            for course in page:
+                yield {"id": entity_id(course), **{prop: course.get(prop) for prop in COURSE_PROPERTIES}}
+
+    return export_response(rows(), CATALOG_COLUMNS, fmt, 'courses')
+
+
+@app.route('/courses/import', methods=['POST'])
+def import_courses():
+    """
+    POST /courses/import
+    Admin only. Creates one course per CSV or NDJSON row (subject, number,
+    title, term, instructor_id; an id column is ignored). Instructors are
+    validated with one get_multi per batch of rows; rejected rows are
+    reported and the rest are still created.
+    Response: { "rows", "created", "failed", "errors": [ { "line", "Error" } ] }
+    """
+    payload, calling_user = require_auth_and_get_user(request)
+    check_admin(calling_user)
+
+    try:
+        rows = read_import_rows(bulk_format(request.mimetype), COURSE_PROPERTIES)
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    report = {"rows": 0, "created": 0, "failed": 0, "errors": []}
+    for batch in import_batches(rows):
+        report['rows'] += len(batch)
+        parsed = []
+        for line, row, error in batch:
+            if error:
+                reject_row(report, line, error)
+                continue
+            try:
+                values = {prop: row[prop] for prop in COURSE_PROPERTIES}
+                values['number'] = int(values['number'])
+                values['instructor_id'] = int(values['instructor_id'])
+            except (KeyError, TypeError, ValueError):
+                reject_row(report, line, "The request body is invalid")
+                continue
+            parsed.append((line, values))
+
+        instructors = get_users_by_ids({values['instructor_id'] for _, values in parsed})
+        new_courses = []
+        for line, values in parsed:
+            instructor = instructors.get(values['instructor_id'])
+            if not instructor or instructor.get('role') != 'instructor':
+                reject_row(report, line, "The request body is invalid")
+                continue
+            course = datastore.Entity(key=get_datastore_client().key(COURSES_KIND))
+            course.update(values)
+            course.update({"version": 1, "roster_version": 1})
+            course.exclude_from_indexes.update(('version', 'roster_version'))
+            if ENROLLMENT_STORAGE == 'list':
+                course['students'] = []
+            new_courses.append(course)
+
+        # Each course is committed with its change entry, so a transaction
+        # holds half a write batch of courses
+        chunk_size = WRITE_BATCH_SIZE // 2
+        for i in range(0, len(new_courses), chunk_size):
+            chunk = new_courses[i:i + chunk_size]
+            with backend_timer('datastore'):
+                keys = get_datastore_client().allocate_ids(get_datastore_client().key(COURSES_KIND), len(chunk))
+            changes = []
+            for course, key in zip(chunk, keys):
+                course.key = key
+                changes.append(change_entity('course.create', key.id, course))
+            run_in_transaction(lambda: get_datastore_client().put_multi(chunk + changes))
+        if new_courses:
+            report['created'] += len(new_courses)
+            course_cache.invalidate()
+
+    return jsonify(report), 200
+
+
+@app.route('/rosters/export', methods=['GET'])
+def export_rosters():
+    """
+    GET /rosters/export
+    Admin or instructor. Streams (course_id, student_id) rows as CSV or
+    NDJSON for the courses in ?ids=1,2,3, or else for every course the
+    caller manages (all courses for an admin, their own for an instructor).
+    """
+    payload, calling_user = require_auth_and_get_user(request)
+    is_admin = calling_user.get('role') == 'admin'
+    if not is_admin and calling_user.get('role') != 'instructor':
+        raise AuthError({"Error": "You don't have permission on this resource"}, 403)
+
+    try:
+        fmt = bulk_format(request.accept_mimetypes.best_match(BULK_FORMATS.values()))
+        course_ids = parse_batch_ids(request.args['ids']) if 'ids' in request.args else None
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    if course_ids is not None:
+        # Same checks as GET /courses/<id>/students, for every listed course
+        courses = get_entities_by_ids(COURSES_KIND, course_ids)
+        for cid in course_ids:
+            if cid not in courses:
+                raise AuthError({"Error": "Not found"}, 403)
+            if not is_admin and courses[cid].get('instructor_id') != calling_user.key.id:
+                raise AuthError({"Error": "You don't have permission on this resource"}, 403)
+        course_pages = [[courses[cid] for cid in dict.fromkeys(course_ids)]]
+    elif is_admin and ENROLLMENT_STORAGE == 'entity':
+        # Every roster: one keys-only scan of the enrollments kind beats a
+        # roster query per course
+        query = get_datastore_client().query(kind=ENROLLMENTS_KIND)
+        query.keys_only()
+        rows = ({"course_id": cid, "student_id": sid}
+                for page in fetch_pages(query)
+                for cid, sid in (ids_from_enrollment_key(e.key) for e in page))
+        return export_response(rows, ROSTER_COLUMNS, fmt, 'rosters')
+    else:
+        query = get_datastore_client().query(kind=COURSES_KIND)
+        if not is_admin:
+            query.add_filter('instructor_id', '=', calling_user.key.id)
+        if ENROLLMENT_STORAGE == 'entity':
+            # Rosters are paged in per course below; only the IDs are needed
+            query.keys_only()
+        course_pages = fetch_pages(query)
+
+    def rows():
+        for page in course_pages:
+            for course in page:
+                course_id = entity_id(course)
+                if ENROLLMENT_STORAGE == 'list':
+                    for sid in course.get('students', []):
+                        yield {"course_id": course_id, "student_id": sid}
+                    continue
+                cursor = None
+                while True:
+                    student_ids, cursor = fetch_enrollment_page(course_id, cursor, ENROLLMENT_PAGE_SIZE)
+                    for sid in student_ids:
+                        yield {"course_id": course_id, "student_id": sid}
+                    if not cursor:
+                        break
+
+    return export_response(rows(), ROSTER_COLUMNS, fmt, 'rosters')
+
+
+@app.route('/rosters/import', methods=['POST'])
+def import_rosters():
+    """
+    POST /rosters/import
+    Admin or course instructor. Applies one enrollment change per CSV or
+    NDJSON row (course_id, student_id, optional action "add" or "remove";
+    default "add") across any number of courses. Each batch of rows is
+    validated with one get_multi for its courses and one for its students,
+    then applied per course as PATCH /courses/<id>/students would.
+    Rejected rows are reported and the rest are still applied.
+    Response: { "rows", "added", "removed", "failed", "errors": [ { "line", "Error" } ] }
+    """
+    payload, calling_user = require_auth_and_get_user(request)
+    is_admin = calling_user.get('role') == 'admin'
+    if not is_admin and calling_user.get('role') != 'instructor':
+        raise AuthError({"Error": "You don't have permission on this resource"}, 403)
+
+    try:
+        rows = read_import_rows(bulk_format(request.mimetype), ROSTER_COLUMNS)
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    report = {"rows": 0, "added": 0, "removed": 0, "failed": 0, "errors": []}
+    for batch in import_batches(rows):
+        report['rows'] += len(batch)
+        parsed = []
+        for line, row, error in batch:
+            if error:
+                reject_row(report, line, error)
+                continue
+            try:
+                course_id, student_id = int(row['course_id']), int(row['student_id'])
+            except (KeyError, TypeError, ValueError):
+                reject_row(report, line, "The request body is invalid")
+                continue
+            action = row.get('action', 'add')
+            if action not in ('add', 'remove'):
+                reject_row(report, line, "The request body is invalid")
+                continue
+            parsed.append((line, course_id, student_id, action))
+
+        courses, students = run_concurrently(
+            lambda: get_entities_by_ids(COURSES_KIND, {p[1] for p in parsed}),
+            lambda: get_users_by_ids({p[2] for p in parsed})
+        )
+
+        # course_id -> (students to add, students to remove, row lines)
+        changes = {}
+        for line, course_id, student_id, action in parsed:
+            course = courses.get(course_id)
+            if not course:
+                reject_row(report, line, "Not found")
+                continue
+            if not is_admin and course.get('instructor_id') != calling_user.key.id:
+                reject_row(report, line, "You don't have permission on this resource")
+                continue
+            if student_id not in students or students[student_id].get('role') != 'student':
+                reject_row(report, line, "Enrollment data is invalid")
+                continue
+            add_ids, remove_ids, lines = changes.setdefault(course_id, (set(), set(), []))
+            wanted, opposite = (add_ids, remove_ids) if action == 'add' else (remove_ids, add_ids)
+            # Adding and removing one student in the same batch is ambiguous,
+            # as it is in a PATCH body
+            if student_id in opposite:
+                reject_row(report, line, "Enrollment data is invalid")
+                continue
+            wanted.add(student_id)
+            lines.append(line)
+
+        course_ids = list(changes)
+        applied = run_concurrently(*(lambda cid=cid: apply_roster_change(courses[cid].key, *changes[cid][:2])
+                                     for cid in course_ids))
+        for cid, found in zip(course_ids, applied):
+            add_ids, remove_ids, lines = changes[cid]
+            if not found:
+                # Deleted while the import ran
+                for line in lines:
+                    reject_row(report, line, "Not found")
+                continue
+            report['added'] += len(add_ids)
+            report['removed'] += len(remove_ids)
+
+    report['errors'].sort(key=lambda e: e['line'])
+    return jsonify(report), 200
+
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    """
+    GET /changes?since=<cursor>&limit=N
+    Admin only. Course and roster changes written after since (from the
+    start of the retained log when omitted), oldest first, at most limit
+    (up to CHANGES_PAGE_SIZE) per page. Changes younger than
+    CHANGES_SETTLE_SECONDS are held back until earlier transactions have
+    committed. Pass the returned cursor as the next since. Returns 410 if
+    since is older than the retention horizon: the caller missed expired
+    changes and has to resync (e.g. from /courses/export and /rosters/export).
+    Response: { "changes": [...], "cursor": "...", "more": bool, "next": url }
+    """
+    payload, calling_user = require_auth_and_get_user(request)
+    check_admin(calling_user)
+
+    since = request.args.get('since')
+    try:
+        limit = int(request.args.get('limit', CHANGES_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"Error": "The request body is invalid"}), 400
+    if limit < 1 or (since is not None and not CHANGE_ID_PATTERN.fullmatch(since)):
+        return jsonify({"Error": "The request body is invalid"}), 400
+    limit = min(limit, CHANGES_PAGE_SIZE)
+
+    # Only entries named before this instant are served
+    settled = f"{time.time_ns() - int(CHANGES_SETTLE_SECONDS * 1e9):020d}"
+
+    def read_page():
+        query = get_datastore_client().query(kind=CHANGES_KIND)
+        if since:
+            query.key_filter(get_datastore_client().key(CHANGES_KIND, since), '>')
+        query.key_filter(get_datastore_client().key(CHANGES_KIND, settled), '<')
+        query.order = ['__key__']
+        with backend_timer('datastore'):
+            # One extra entry tells whether another page is ready
+            return list(query.fetch(limit=limit + 1))
+
+    def read_horizon():
+        with backend_timer('datastore'):
+            return get_datastore_client().get(get_datastore_client().key(CHANGE_LOG_KIND, 'horizon'))
+
+    changes, horizon = run_concurrently(read_page, read_horizon)
+    if since and horizon and since < horizon['expired_through']:
+        return jsonify({"Error": "Changes since this cursor have expired"}), 410
+
+    more = len(changes) > limit
+    changes = changes[:limit]
+    cursor = changes[-1].key.name if changes else since
+    response_body = {
+        "changes": [change_response(change) for change in changes],
+        "cursor": cursor,
+        "more": more,
+        "next": url_for('get_changes', since=cursor, limit=limit, _external=True)
+                if cursor else url_for('get_changes', limit=limit, _external=True)
+    }
+    return jsonify(response_body), 200
+
+
+for route in route_limiters:
+    if route not in app.view_functions:
+        print(f"ROUTE_CONCURRENCY names an unknown endpoint: {route}")
 
+startup_report["import_seconds"] = time.perf_counter() - _IMPORT_STARTED
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)